@@ -0,0 +1,291 @@
+# Batched self-play simulator for the tiles game.
+#
+# Plays a large number of games in lockstep with NumPy. Every game is a row
+# in a set of arrays (tiles, rotations, placer ids, token squares and
+# positions), and each step makes one move in every game that is still
+# running: the tile placement and the token movement that follows are done
+# for all games at once with lookups into tables built from tiles.py.
+#
+# The players make random legal moves, following the same rules as the
+# server. Run with --check to replay every game through tiles.Board and
+# compare the results.
+#
+# Usage: python batchsim.py [--games G] [--players P] [--seed N] [--check]
+
+import argparse
+import time
+import numpy as np
+import tiles
+
+
+WIDTH = tiles.BOARD_WIDTH
+HEIGHT = tiles.BOARD_HEIGHT
+SQUARES = WIDTH * HEIGHT
+TILE_COUNT = len(tiles.ALL_TILES)
+
+# Exit position and position in the next square for every
+# (tileid*4 + rotation)*8 + position, see tiles.TILE_TRANSITIONS
+_transitions = np.array(tiles.TILE_TRANSITIONS, dtype=np.intp)
+EXIT_POSITION = _transitions[:, 0]
+NEXT_POSITION = _transitions[:, 3]
+
+# Square reached through each exit position of each square, -1 off the board
+NEIGHBOURS = np.array(tiles.square_neighbours(WIDTH, HEIGHT), dtype=np.intp)
+
+# Token start positions allowed on each square (the ones facing the edge),
+# see tiles.square_edge_ports. Squares with any are where first tiles can go.
+START_POSITIONS = np.zeros((SQUARES, 8), dtype=bool)
+for _idx, _ports in enumerate(tiles.square_edge_ports(WIDTH, HEIGHT)):
+    START_POSITIONS[_idx, list(_ports)] = True
+EDGE_SQUARES = START_POSITIONS.any(axis=1)
+
+# Kinds of move, by turn number
+MOVE_FIRST_TILE = 1
+MOVE_START_POSITION = 2
+MOVE_TILE = 3
+
+
+class BatchBoard:
+    # The state of a batch of games with the same number of players. Player
+    # p of a game is seated p-th in the turn order.
+
+    def __init__(self, games, players, seed=None, record=False):
+        self.games = games
+        self.players = players
+        self.rng = np.random.default_rng(seed)
+
+        self.tileids = np.full((games, SQUARES), -1, dtype=np.int16)
+        self.tilerotations = np.zeros((games, SQUARES), dtype=np.int8)
+        self.tileplaceids = np.full((games, SQUARES), -1, dtype=np.int8)
+
+        self.token_squares = np.full((games, players), -1, dtype=np.int16)
+        self.token_positions = np.zeros((games, players), dtype=np.int8)
+        self.alive = np.ones((games, players), dtype=bool)
+        self.start_squares = np.full((games, players), -1, dtype=np.int16)
+        self.turns = np.zeros((games, players), dtype=np.int32)
+        self.hands = self.rng.integers(
+            0, TILE_COUNT, (games, players, tiles.HAND_SIZE), dtype=np.int16)
+
+        self.current = np.zeros(games, dtype=np.intp)
+        self.running = np.ones(games, dtype=bool)
+        self.game_turns = np.zeros(games, dtype=np.int32)
+
+        # Moves made, for replaying the games through tiles.Board
+        self.record = [] if record else None
+
+    # Picks one random True column in each row of mask
+    def random_choice(self, mask):
+        scores = self.rng.random(mask.shape)
+        scores[~mask] = -1
+        return scores.argmax(axis=1)
+
+    # Makes one move in every running game. Returns the number of moves made.
+    def step(self):
+        g = np.flatnonzero(self.running)
+        if not g.size:
+            return 0
+
+        p = self.current[g]
+        turn = self.turns[g, p] + 1
+        self.turns[g, p] = turn
+        self.game_turns[g] += 1
+
+        kind = np.minimum(turn, MOVE_TILE)
+        squares = self.token_squares[g, p].astype(np.intp)
+        tileid = np.full(g.size, -1, dtype=np.intp)
+        rotation = np.zeros(g.size, dtype=np.intp)
+        position = np.full(g.size, -1, dtype=np.intp)
+
+        # First turn: a tile on any empty square on the edge of the board
+        first = kind == MOVE_FIRST_TILE
+        if first.any():
+            empty = EDGE_SQUARES & (self.tileids[g[first]] < 0)
+            squares[first] = self.random_choice(empty)
+            self.start_squares[g[first], p[first]] = squares[first]
+
+        # Second turn: the token enters the board from the first tile
+        start = kind == MOVE_START_POSITION
+        if start.any():
+            gs, ps = g[start], p[start]
+            squares[start] = self.start_squares[gs, ps]
+            position[start] = self.random_choice(
+                START_POSITIONS[squares[start]])
+            self.token_squares[gs, ps] = squares[start]
+            self.token_positions[gs, ps] = position[start]
+
+        # Every other turn places a tile from the hand
+        place = ~start
+        if place.any():
+            gp, pp, sp = g[place], p[place], squares[place]
+            slot = self.rng.integers(0, tiles.HAND_SIZE, gp.size)
+            tileid[place] = self.hands[gp, pp, slot]
+            rotation[place] = self.rng.integers(0, 4, gp.size)
+            self.tileids[gp, sp] = tileid[place]
+            self.tilerotations[gp, sp] = rotation[place]
+            self.tileplaceids[gp, sp] = pp
+            # The played tile is replaced with a new one
+            self.hands[gp, pp, slot] = self.rng.integers(
+                0, TILE_COUNT, gp.size)
+
+        alive_before = self.alive[g]
+        self.move_tokens(g, squares)
+        eliminated = alive_before & ~self.alive[g]
+
+        if self.record is not None:
+            self.record.append((g, p, kind, squares, tileid, rotation,
+                                position, eliminated))
+
+        # Games with one player (or none) left are over
+        over = self.alive[g].sum(axis=1) <= 1
+        self.running[g[over]] = False
+
+        # Next live player in turn order
+        g, p = g[~over], p[~over]
+        alive = self.alive[g]
+        nxt = p.copy()
+        found = np.zeros(g.size, dtype=bool)
+        for offset in range(1, self.players + 1):
+            candidate = (p + offset) % self.players
+            pick = ~found & alive[np.arange(g.size), candidate]
+            nxt[pick] = candidate[pick]
+            found |= pick
+        self.current[g] = nxt
+
+        return len(turn)
+
+    # Moves the live tokens on the given square of each game g, which has
+    # just had a tile placed on it (or a token started on it). This is the
+    # batched version of Board.do_player_movement_at.
+    def move_tokens(self, g, squares):
+        on_square = (self.token_squares[g] == squares[:, None]) & self.alive[g]
+        rows, p = np.nonzero(on_square)
+        g = g[rows]
+        idx = squares[rows]
+        position = self.token_positions[g, p].astype(np.intp)
+        tileid = self.tileids[g, idx].astype(np.intp)
+
+        while g.size:
+            transition = (tileid*4 + self.tilerotations[g, idx])*8 + position
+            exit_position = EXIT_POSITION[transition]
+            nidx = NEIGHBOURS[idx*8 + exit_position]
+
+            # Tokens leaving the board are eliminated on the square they left
+            off = nidx < 0
+            if off.any():
+                go, po = g[off], p[off]
+                self.token_squares[go, po] = idx[off]
+                self.token_positions[go, po] = exit_position[off]
+                self.alive[go, po] = False
+
+            # The others move into the next square, and stop if it is empty
+            on = ~off
+            g, p = g[on], p[on]
+            idx = nidx[on]
+            position = NEXT_POSITION[transition[on]]
+            tileid = self.tileids[g, idx].astype(np.intp)
+
+            stop = tileid < 0
+            if stop.any():
+                self.token_squares[g[stop], p[stop]] = idx[stop]
+                self.token_positions[g[stop], p[stop]] = position[stop]
+
+            go_on = ~stop
+            g, p, idx = g[go_on], p[go_on], idx[go_on]
+            position, tileid = position[go_on], tileid[go_on]
+
+    # Plays every game to the end. Returns the number of moves made.
+    def run(self):
+        moves = 0
+        while True:
+            made = self.step()
+            if not made:
+                return moves
+            moves += made
+
+    # Replays every game through tiles.Board and compares each move and the
+    # final state. Returns a list of (game, message) for every difference.
+    def check(self):
+        errors = []
+        boards = [tiles.Board() for _ in range(self.games)]
+        live = [list(range(self.players)) for _ in range(self.games)]
+
+        for g, p, kind, squares, tileid, rotation, position, eliminated \
+                in self.record:
+            for i in range(len(g)):
+                game = int(g[i])
+                board = boards[game]
+                idnum = int(p[i])
+                y, x = divmod(int(squares[i]), WIDTH)
+
+                if kind[i] == MOVE_START_POSITION:
+                    ok = board.set_player_start_position(
+                        idnum, x, y, int(position[i]))
+                else:
+                    ok = board.set_tile(
+                        x, y, int(tileid[i]), int(rotation[i]), idnum)
+                if not ok:
+                    errors.append((game, 'illegal move {} by player {} at '
+                                   '{},{}'.format(kind[i], idnum, x, y)))
+
+                _, out = board.do_player_movement(live[game])
+                for idnum in out:
+                    live[game].remove(idnum)
+                expected = set(np.flatnonzero(eliminated[i]).tolist())
+                if set(out) != expected:
+                    errors.append((game, 'eliminated {} instead of {}'.format(
+                        sorted(expected), sorted(out))))
+
+        for game, board in enumerate(boards):
+            tileids = [-1 if t is None else t for t in board.tileids]
+            if tileids != self.tileids[game].tolist():
+                errors.append((game, 'tiles differ'))
+            for idnum in range(self.players):
+                if not board.have_player_position(idnum):
+                    if self.token_squares[game, idnum] >= 0:
+                        errors.append((game, 'player {} has no token'.format(
+                            idnum)))
+                    continue
+                x, y, position = board.get_player_position(idnum)
+                if (self.token_squares[game, idnum],
+                        self.token_positions[game, idnum]) != \
+                        (board.tile_index(x, y), position):
+                    errors.append((game, 'player {} token differs'.format(
+                        idnum)))
+            if sorted(live[game]) != np.flatnonzero(self.alive[game]).tolist():
+                errors.append((game, 'live players differ'))
+
+        return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Play many games of tiles at once with NumPy.')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--players', type=int, default=tiles.PLAYER_LIMIT)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--check', action='store_true',
+                        help='replay every game through tiles.Board')
+    args = parser.parse_args()
+
+    batch = BatchBoard(args.games, args.players, args.seed, args.check)
+    start = time.perf_counter()
+    moves = batch.run()
+    elapsed = time.perf_counter() - start
+
+    print('{} games, {} moves in {:.2f} s'.format(
+        args.games, moves, elapsed))
+    print('{:.0f} moves/s, {:.0f} games/s'.format(
+        moves / elapsed, args.games / elapsed))
+    print('mean game length {:.1f} moves'.format(batch.game_turns.mean()))
+
+    if args.check:
+        errors = batch.check()
+        for game, message in errors[:20]:
+            print('game {}: {}'.format(game, message))
+        print('check: {} differences'.format(len(errors)))
+        if errors:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
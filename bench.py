@@ -0,0 +1,295 @@
+# Benchmarks for the tiles protocol and game logic.
+#
+# Measures packing and unpacking of every message type, decoding of a
+# realistic mixed stream of messages, the Board methods used by the server
+# and complete simulated games. Everything random is seeded so that runs can
+# be compared, and the results are written as JSON.
+#
+# Usage: python bench.py [--output FILE] [--filter TEXT] [--seed N]
+
+import argparse
+import copy
+import json
+import platform
+import random
+import sys
+import time
+import tiles
+
+
+# Plays a complete game on board through the Board API, the same way the
+# server does. The players make random legal moves.
+#
+# If hook is given it is called as hook(name, board, args) right before each
+# call of a Board method, so benchmarks can collect real game states. If
+# record is given, every message the server would broadcast is appended to it.
+def play_game(rng, board, nplayers, hook=None, record=None):
+    board.reset()
+    idnums = list(range(nplayers))
+    live = list(idnums)
+    hands = {}
+    turns = {}
+
+    if record is not None:
+        for idnum in idnums:
+            record.append(tiles.MessagePlayerJoined(
+                'player{}'.format(idnum), idnum))
+        record.append(tiles.MessageCountdown())
+        record.append(tiles.MessageGameStart())
+
+    for idnum in idnums:
+        hands[idnum] = [rng.randrange(len(tiles.ALL_TILES))
+                        for _ in range(tiles.HAND_SIZE)]
+        turns[idnum] = 0
+        if record is not None:
+            for tileid in hands[idnum]:
+                record.append(tiles.MessageAddTileToHand(tileid))
+
+    while len(live) > 1:
+        for idnum in idnums:
+            if idnum not in live:
+                continue
+            if record is not None:
+                record.append(tiles.MessagePlayerTurn(idnum))
+            turns[idnum] += 1
+            hand = hands[idnum]
+
+            if turns[idnum] == 2:
+                args = (idnum,) + rng.choice(
+                    board.legal_start_positions(idnum))
+                x, y = args[1:3]
+                if hook:
+                    hook('set_player_start_position', board, args)
+                board.set_player_start_position(*args)
+                if record is not None:
+                    record.append(tiles.MessageMoveToken(*args))
+            else:
+                x, y = rng.choice(board.legal_tile_squares(idnum))
+                tileid = rng.choice(hand)
+                args = (x, y, tileid, rng.randrange(4), idnum)
+                if hook:
+                    hook('set_tile', board, args)
+                board.set_tile(*args)
+                hand.remove(tileid)
+                hand.append(rng.randrange(len(tiles.ALL_TILES)))
+                if record is not None:
+                    record.append(tiles.MessagePlaceTile(
+                        idnum, tileid, args[3], x, y))
+                    record.append(tiles.MessageAddTileToHand(hand[-1]))
+
+            if hook:
+                hook('do_player_movement', board, (list(live),))
+                hook('do_player_movement_at', board, (x, y, list(live)))
+            positionupdates, eliminated = board.do_player_movement_at(
+                x, y, live)
+            if record is not None:
+                record.extend(positionupdates)
+            for eliminated_id in eliminated:
+                live.remove(eliminated_id)
+                if record is not None:
+                    record.append(tiles.MessagePlayerEliminated(eliminated_id))
+
+            if len(live) <= 1:
+                break
+
+    return turns
+
+
+# Runs func(n) repeat times and returns the best time per operation
+def measure(func, n, repeat):
+    best = None
+    for _ in range(repeat):
+        elapsed = func(n)
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        'ns_per_op': best / n * 1e9,
+        'ops_per_sec': n / best if best else 0.0,
+        'n': n,
+    }
+
+
+def timed_loop(call, args):
+    start = time.perf_counter()
+    for arg in args:
+        call(arg)
+    return time.perf_counter() - start
+
+
+# One sample instance of every message type
+def sample_messages():
+    return [
+        tiles.MessageWelcome(12),
+        tiles.MessagePlayerJoined('player12', 12),
+        tiles.MessagePlayerLeft(12),
+        tiles.MessageCountdown(),
+        tiles.MessageGameStart(),
+        tiles.MessageAddTileToHand(7),
+        tiles.MessagePlayerTurn(12),
+        tiles.MessagePlaceTile(12, 7, 3, 0, 4),
+        tiles.MessageMoveToken(12, 0, 4, 6),
+        tiles.MessagePlayerEliminated(12),
+    ]
+
+
+def bench_messages(results, n, repeat):
+    for msg in sample_messages():
+        name = type(msg).__name__
+        # pack() returns the bytes cached by the first call, so the encoding
+        # itself is timed through _pack()
+        encode = msg._pack
+        results[name + '.pack'] = measure(
+            lambda n: timed_loop(lambda _: encode(), range(n)), n, repeat)
+
+        if not hasattr(msg, 'unpack'):
+            continue
+        packed = bytearray(msg.pack())
+        unpack = type(msg).unpack
+        results[name + '.unpack'] = measure(
+            lambda n: timed_loop(lambda _: unpack(packed), range(n)),
+            n, repeat)
+
+
+# Builds the byte stream a spectator would receive for a number of games
+def mixed_stream(rng, games):
+    record = [tiles.MessageWelcome(0)]
+    board = tiles.Board()
+    for _ in range(games):
+        play_game(rng, board, rng.randint(2, tiles.PLAYER_LIMIT),
+                  record=record)
+    return bytearray(b''.join(msg.pack() for msg in record)), len(record)
+
+
+def bench_stream(results, rng, repeat):
+    stream, count = mixed_stream(rng, 100)
+
+    def read_all(_):
+        start = time.perf_counter()
+        offset = 0
+        while True:
+            msg, consumed = tiles.read_message_from_bytearray(stream, offset)
+            if not consumed:
+                break
+            offset += consumed
+        return time.perf_counter() - start
+
+    def decode_all(_):
+        start = time.perf_counter()
+        decoder = tiles.MessageDecoder()
+        # Fed in the chunks a socket would hand over
+        for i in range(0, len(stream), 4096):
+            decoder.feed(stream[i:i + 4096])
+            for msg in decoder:
+                pass
+        return time.perf_counter() - start
+
+    def decode_columns(_):
+        start = time.perf_counter()
+        tiles.decode_columns(stream)
+        return time.perf_counter() - start
+
+    for name, func in (('read_message_from_bytearray.mixed', read_all),
+                       ('MessageDecoder.mixed', decode_all),
+                       ('decode_columns.mixed', decode_columns)):
+        results[name] = measure(func, count, repeat)
+        results[name]['bytes'] = len(stream)
+
+
+# Collects (board, args) pairs for every call of a Board method made while
+# playing the given number of games
+def board_states(rng, games):
+    states = {}
+
+    def hook(name, board, args):
+        states.setdefault(name, []).append((copy.deepcopy(board), args))
+
+    board = tiles.Board()
+    for _ in range(games):
+        play_game(rng, board, rng.randint(2, tiles.PLAYER_LIMIT), hook)
+    return states
+
+
+def bench_board(results, rng, repeat):
+    states = board_states(rng, 200)
+
+    calls = {
+        'set_tile': lambda board, args: board.set_tile(*args),
+        'set_player_start_position':
+            lambda board, args: board.set_player_start_position(*args),
+        'do_player_movement':
+            lambda board, args: board.do_player_movement(*args),
+        'do_player_movement_at':
+            lambda board, args: board.do_player_movement_at(*args),
+    }
+
+    for name, call in calls.items():
+        samples = states[name]
+
+        # Every call changes its board, so each repeat gets fresh copies
+        def run(_, samples=samples, call=call):
+            boards = [(copy.deepcopy(board), args) for board, args in samples]
+            start = time.perf_counter()
+            for board, args in boards:
+                call(board, args)
+            return time.perf_counter() - start
+
+        results['Board.' + name] = measure(run, len(samples), repeat)
+
+
+def bench_games(results, seed, games, repeat):
+    def run(n):
+        rng = random.Random(seed)
+        board = tiles.Board()
+        start = time.perf_counter()
+        for _ in range(n):
+            play_game(rng, board, tiles.PLAYER_LIMIT)
+        return time.perf_counter() - start
+
+    result = measure(run, games, repeat)
+    result['games_per_sec'] = result['ops_per_sec']
+    results['game.simulated'] = result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for the tiles protocol and game logic.')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON results to this file')
+    parser.add_argument('--filter', default='',
+                        help='only keep results whose name contains this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--number', type=int, default=100000,
+                        help='iterations for each message benchmark')
+    parser.add_argument('--games', type=int, default=2000,
+                        help='games for the simulated game benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = {}
+    bench_messages(results, args.number, args.repeat)
+    bench_stream(results, rng, args.repeat)
+    bench_board(results, rng, args.repeat)
+    bench_games(results, args.seed, args.games, args.repeat)
+
+    results = {name: result for name, result in results.items()
+               if args.filter in name}
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
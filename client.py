@@ -17,6 +17,7 @@ import socket
 import sys
 import threading
 import select
+import time
 
 class Application(Frame):
   TILE_PX = 80 # pixels
@@ -27,6 +28,8 @@ class Application(Frame):
   BOARD_HEIGHT = tiles.BOARD_HEIGHT
   HAND_SIZE = tiles.HAND_SIZE
 
+  FRAME_SECONDS = 1 / 60 # shortest time between redraws
+
   BOARD_WIDTH_PX = TILE_PX * BOARD_WIDTH
   BOARD_HEIGHT_PX = TILE_PX * BOARD_HEIGHT
   HAND_WIDTH_PX = TILE_PX * HAND_SIZE + HAND_SPACING_PX * (HAND_SIZE - 1)
@@ -68,11 +71,14 @@ class Application(Frame):
     self.selected_hand = 0
     self.handrects = [None] * Application.HAND_SIZE
 
-    self.bind('<<ClearBoard>>', lambda ev: self.clear_board())
-    self.bind('<<RedrawBoard>>', lambda ev: self.draw_board())
-    self.bind('<<RedrawHand>>', lambda ev: self.draw_hand())
-    self.bind('<<RedrawTokens>>', lambda ev: self.draw_tokens())
-    self.bind('<<RedrawTurn>>', lambda ev: self.draw_turn())
+    # parts of the window the communication thread has changed, redrawn
+    # together at most once a frame
+    self.dirtylock = threading.Lock()
+    self.dirty = set()
+    self.redrawpending = False
+    self.lastredraw = 0
+
+    self.bind('<<Redraw>>', lambda ev: self.schedule_redraw())
     self.bind('<<CloseConnection>>', lambda ev: on_quit())
 
     self.create_widgets()
@@ -159,12 +165,12 @@ class Application(Frame):
   def clear_board(self):
     self.canvas.configure(bg='white')
     self.canvas.itemconfigure('board_square', fill="#bbb", activefill="#fff")
-    self.canvas.delete('board_tile')
     self.canvas.delete('selection_token')
-    self.canvas.delete('token')
+    self.board.clear_drawing(self.canvas)
   
   def draw_board(self):
-    self.board.draw_tiles(self.canvas, self.boardoffset)
+    with self.boardlock:
+      self.board.draw_tiles(self.canvas, self.boardoffset)
   
   def draw_hand(self):
     hand_offset = self.hand_offset
@@ -182,12 +188,56 @@ class Application(Frame):
     with self.boardlock:
       if self.lasttilelocation and not self.location:
         x, y = self.lasttilelocation
+        self.canvas.delete('selection_token')
         self.board.draw_selection_tokens(self.canvas, self.boardoffset, self.playernums, x, y, self.choose_starting_token)
       else:
         self.canvas.delete('selection_token')
       
       self.board.draw_tokens(self.canvas, self.boardoffset, self.playernums, self.eliminatedlist)
   
+  def mark_dirty(self, *parts):
+    with self.dirtylock:
+      self.dirty.update(parts)
+  
+  def request_redraw(self):
+    # called by the communication thread after each batch of messages; only
+    # one request is ever waiting to be handled
+    with self.dirtylock:
+      if not self.dirty or self.redrawpending:
+        return
+      self.redrawpending = True
+    
+    self.event_generate('<<Redraw>>')
+  
+  def schedule_redraw(self):
+    wait = self.lastredraw + Application.FRAME_SECONDS - time.monotonic()
+    if wait > 0:
+      self.after(int(wait * 1000) + 1, self.redraw)
+    else:
+      self.redraw()
+  
+  def redraw(self):
+    with self.dirtylock:
+      dirty = self.dirty
+      self.dirty = set()
+      self.redrawpending = False
+    
+    self.lastredraw = time.monotonic()
+
+    if 'clear' in dirty:
+      self.clear_board()
+    if 'board' in dirty:
+      self.draw_board()
+    if 'hand' in dirty:
+      self.draw_hand()
+    if 'tokens' in dirty:
+      self.draw_tokens()
+    if 'players' in dirty:
+      with self.boardlock:
+        self.playerlistvar.set(self.playerlist)
+    if 'turn' in dirty:
+      self.draw_turn()
+  
   def draw_turn(self):
     self.canvas.itemconfigure(self.you_won_text, state='hidden')
     self.canvas.itemconfigure(self.eliminated_text, state='hidden')
@@ -229,8 +279,6 @@ def reset_game_state():
     for i in range(len(app.hand)):
       app.hand[i] = None
       app.handrotations[i] = 0
-  
-  app.event_generate("<<RedrawHand>>")
 
   with app.boardlock:
     app.board.reset()
@@ -241,9 +289,7 @@ def reset_game_state():
     app.eliminatedlist.clear()
     app.currentplayerid = None
   
-  app.event_generate("<<ClearBoard>>")
-  app.event_generate("<<RedrawBoard>>")
-  app.event_generate("<<RedrawTurn>>")
+  app.mark_dirty('hand', 'clear', 'board', 'players', 'turn')
 
 def set_player_turn(idnum):
   with app.boardlock:
@@ -254,12 +300,10 @@ def set_player_turn(idnum):
       with app.infolock:
         playername = app.playernames[idnum]
         app.playerlist.append(playername)
-      
-      app.playerlistvar.set(app.playerlist)
     
     app.currentplayerid = idnum
 
-  app.event_generate("<<RedrawTurn>>")
+  app.mark_dirty('players', 'turn')
 
 def set_player_eliminated(idnum):
   with app.boardlock:
@@ -269,13 +313,11 @@ def set_player_eliminated(idnum):
         app.playerlist.remove(playername)
       else:
         print('Unknown player eliminated: {}'.format(idnum))
-    app.playerlistvar.set(app.playerlist)
 
     if not idnum in app.eliminatedlist:
       app.eliminatedlist.append(idnum)
   
-  app.event_generate("<<RedrawTokens>>")
-  app.event_generate("<<RedrawTurn>>")
+  app.mark_dirty('players', 'tokens', 'turn')
 
 def tile_placed(msg):
   print('tile {} at {}, {} : {} from {}'.format(msg.tileid, msg.x, msg.y, msg.rotation, msg.idnum))
@@ -290,7 +332,7 @@ def tile_placed(msg):
     app.board.tilerotations[idx] = msg.rotation
     app.board.tileplaceids[idx] = msg.idnum
   
-  app.event_generate("<<RedrawBoard>>")
+  app.mark_dirty('board')
 
   with app.infolock:
     if app.idnum == msg.idnum:
@@ -306,17 +348,12 @@ def tile_placed(msg):
         app.hand[selected] = None
         app.handrotations[selected] = 0
       
-      app.event_generate("<<RedrawHand>>")
-
-      redrawtokens = False
+      app.mark_dirty('hand')
 
       with app.boardlock:
         app.lasttilelocation = (msg.x, msg.y)
         if app.location == None:
-          redrawtokens = True
-      
-      if redrawtokens:
-        app.event_generate("<<RedrawTokens>>")
+          app.mark_dirty('tokens')
 
 def token_moved(msg):
   with app.boardlock:
@@ -325,7 +362,7 @@ def token_moved(msg):
       app.location = (msg.x, msg.y, msg.position)
     app.board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
   
-  app.event_generate("<<RedrawTokens>>")
+  app.mark_dirty('tokens')
 
 def add_tile_to_hand(tileid):
   with app.handlock:
@@ -334,102 +371,95 @@ def add_tile_to_hand(tileid):
         app.hand[i] = tileid
         app.handrotations[i] = 0
         break
-  app.event_generate("<<RedrawHand>>")
+  app.mark_dirty('hand')
 
 def communication_thread(sock):
-  buffer = bytearray()
+  decoder = tiles.MessageDecoder()
 
   while True:
     try:
-      chunk = sock.recv(4096)
-      if chunk:
-        # Read a chunk from the socket, and add it to the end of our buffer
-        # (in case we had a partial message in the buffer from a previous
-        # chunk, and we need the new chunk to complete it)
-        buffer.extend(chunk)
-
-        # Unpack as many messages as we can from the buffer.
-        while True:
-          msg, consumed = tiles.read_message_from_bytearray(buffer)
+      # Read a chunk from the socket into the end of the decoder's buffer
+      # (in case we had a partial message in the buffer from a previous
+      # chunk, and we need the new chunk to complete it)
+      if decoder.recv_into(sock):
+        # Unpack as many messages as we can from the buffer. They only update
+        # the game state; the window is redrawn once they are all applied.
+        for msg in decoder:
+          if isinstance(msg, tiles.MessageWelcome):
+            print('Welcome!')
+            with app.infolock:
+              app.idnum = msg.idnum
+              app.playernames[app.idnum] = 'Me!'
           
-          if consumed:
-            buffer = buffer[consumed:]
-
-            if isinstance(msg, tiles.MessageWelcome):
-              print('Welcome!')
-              with app.infolock:
-                app.idnum = msg.idnum
-                app.playernames[app.idnum] = 'Me!'
-            
-            elif isinstance(msg, tiles.MessagePlayerJoined):
-              print('Player {} joined, id {}'.format(msg.name, msg.idnum))
-              with app.infolock:
-                app.playernames[msg.idnum] = msg.name
-            
-            elif isinstance(msg, tiles.MessagePlayerLeft):
-              print('Player id {} left'.format(msg.idnum))
-              with app.infolock:
-                if msg.idnum in app.playernames:
-                  del app.playernames[msg.idnum]
-                else:
-                  print("...I didn't know they were a player!")
-            
-            elif isinstance(msg, tiles.MessageCountdown):
-              print('Countdown starting...')
-            
-            elif isinstance(msg, tiles.MessageGameStart):
-              print('Game starting...')
-              reset_game_state()
+          elif isinstance(msg, tiles.MessagePlayerJoined):
+            print('Player {} joined, id {}'.format(msg.name, msg.idnum))
+            with app.infolock:
+              app.playernames[msg.idnum] = msg.name
+          
+          elif isinstance(msg, tiles.MessagePlayerLeft):
+            print('Player id {} left'.format(msg.idnum))
+            with app.infolock:
+              if msg.idnum in app.playernames:
+                del app.playernames[msg.idnum]
+              else:
+                print("...I didn't know they were a player!")
+          
+          elif isinstance(msg, tiles.MessageCountdown):
+            print('Countdown starting...')
+          
+          elif isinstance(msg, tiles.MessageGameStart):
+            print('Game starting...')
+            reset_game_state()
+          
+          elif isinstance(msg, tiles.MessageAddTileToHand):
+            print('Add tile {} to hand'.format(msg.tileid))
+            tileid = msg.tileid
             
-            elif isinstance(msg, tiles.MessageAddTileToHand):
-              print('Add tile {} to hand'.format(msg.tileid))
-              tileid = msg.tileid
-              
-              if tileid < 0 or tileid >= len(tiles.ALL_TILES):
-                raise RuntimeError('Unknown tile index {}'.format(tileid))
-              
-              add_tile_to_hand(tileid)
+            if tileid < 0 or tileid >= len(tiles.ALL_TILES):
+              raise RuntimeError('Unknown tile index {}'.format(tileid))
             
-            elif isinstance(msg, tiles.MessagePlayerTurn):
-              print('Player turn: {}'.format(msg))
-
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
-              
-              set_player_turn(msg.idnum)
+            add_tile_to_hand(tileid)
+          
+          elif isinstance(msg, tiles.MessagePlayerTurn):
+            print('Player turn: {}'.format(msg))
+
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
             
-            elif isinstance(msg, tiles.MessagePlaceTile):
-              print('Place tile: {}'.format(msg))
-
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
-              
-              tile_placed(msg)
+            set_player_turn(msg.idnum)
+          
+          elif isinstance(msg, tiles.MessagePlaceTile):
+            print('Place tile: {}'.format(msg))
+
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
             
-            elif isinstance(msg, tiles.MessageMoveToken):
-              print('Move token: {}'.format(msg))
-
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
-              
-              token_moved(msg)
+            tile_placed(msg)
+          
+          elif isinstance(msg, tiles.MessageMoveToken):
+            print('Move token: {}'.format(msg))
+
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
             
-            elif isinstance(msg, tiles.MessagePlayerEliminated):
-              print('Player eliminated: {}'.format(msg))
-
-              with app.infolock:
-                if msg.idnum not in app.playernames:
-                  raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
-              
-              set_player_eliminated(msg.idnum)
+            token_moved(msg)
+          
+          elif isinstance(msg, tiles.MessagePlayerEliminated):
+            print('Player eliminated: {}'.format(msg))
+
+            with app.infolock:
+              if msg.idnum not in app.playernames:
+                raise RuntimeError('Unknown playerid {}'.format(msg.idnum))
             
-            else:
-              print('Unknown message: {}'.format(msg))
+            set_player_eliminated(msg.idnum)
+          
           else:
-            break
+            print('Unknown message: {}'.format(msg))
+        
+        app.request_redraw()
       else:
         break
     except Exception as e:
@@ -0,0 +1,256 @@
+# Append-only log of played games, and a tool to replay it.
+#
+# The log starts with MAGIC, followed by records as the games are played. A
+# record is a RECORD_HEADER (game id, time the table was opened, random seed
+# and payload length) and a payload holding the packed tiles messages a
+# table broadcast since its previous record, so records of tables playing at
+# the same time are interleaved. A game's messages are the payloads of its
+# records in order, and an empty record marks the end of the game. Games
+# without one were still running, or had hung, when the log was last
+# written. The starting position a player chose is logged as the
+# MessageMoveToken the player sent, right before the token's first move.
+#
+# The server writes records with a GameLogWriter, on a thread of its own.
+# Running this module replays a log through tiles.Board, reading it with
+# mmap, and checks that every logged move gives the logged result. With
+# --stats it instead counts what the log holds, decoding each game in bulk.
+#
+# Usage: python gamelog.py [games.log] [--show GAMEID] [--stats]
+
+import argparse
+import collections
+import mmap
+import queue
+import struct
+import threading
+import time
+import tiles
+
+
+MAGIC = b'TILESLOG'
+RECORD_HEADER = struct.Struct('!QdQI')  # gameid, opened, seed, length
+
+
+class GameLogWriter:
+    # Appends records to a log file. Records are handed to a thread that
+    # writes them through a buffered file, so game threads never wait on the
+    # disk. The buffer is flushed whenever the thread runs out of records.
+
+    def __init__(self, path, buffering=1 << 20):
+        self.path = path
+        self.file = open(path, 'ab', buffering=buffering)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.records = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queues a record of a game. payload is the packed messages since the
+    # game's previous record. end=True also queues the record that ends it.
+    def write(self, gameid, opened, seed, payload, end=False):
+        if payload:
+            self.records.put(RECORD_HEADER.pack(
+                gameid, opened, seed, len(payload)) + payload)
+        if end:
+            self.records.put(RECORD_HEADER.pack(gameid, opened, seed, 0))
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            self.file.write(record)
+            if self.records.empty():
+                self.file.flush()
+        self.file.close()
+
+    # Writes out every queued record and closes the file
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+
+# Yields (gameid, opened, seed, payload, ended) for each game of a log that
+# has been mapped into memory. payload is a bytearray of the game's
+# messages, joined from its records. Games are yielded as they end, then the
+# ones that never did with ended False.
+def read_games(buffer):
+    games = {}  # (gameid, opened) -> seed, payload of games not yet ended
+
+    with memoryview(buffer) as view:
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError('not a game log')
+        offset = len(MAGIC)
+
+        while len(view) - offset >= RECORD_HEADER.size:
+            gameid, opened, seed, length = RECORD_HEADER.unpack_from(
+                view, offset)
+            start = offset + RECORD_HEADER.size
+            offset = start + length
+            # A record cut short by a crash ends the log
+            if offset > len(view):
+                break
+            # Game ids start over when the server does, so a game is told
+            # apart by when its table was opened too
+            key = gameid, opened
+            if key not in games:
+                games[key] = seed, bytearray()
+            if length:
+                with view[start:offset] as chunk:
+                    games[key][1].extend(chunk)
+            else:
+                _, payload = games.pop(key)
+                yield gameid, opened, seed, payload, True
+
+    for (gameid, opened), (seed, payload) in games.items():
+        yield gameid, opened, seed, payload, False
+
+
+# Yields every message of a record's payload
+def read_messages(payload):
+    offset = 0
+    while True:
+        msg, consumed = tiles.read_message_from_bytearray(payload, offset)
+        if not consumed:
+            return
+        offset += consumed
+        yield msg
+
+
+# Plays a logged game on board again. Each placement and starting position
+# is made through the Board API, and the token moves and eliminations that
+# follow must match the ones in the log. Returns a list of differences.
+def replay_game(board, payload):
+    board.reset()
+    errors = []
+    live_idnums = set()
+    expected = collections.deque()  # Token moves the replay has made
+
+    for msg in read_messages(payload):
+        if isinstance(msg, tiles.MessagePlayerJoined):
+            live_idnums.add(msg.idnum)
+
+        elif isinstance(msg, tiles.MessagePlaceTile):
+            if msg.tileid >= len(tiles.ALL_TILES) or msg.rotation > 3 or \
+                    not board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation,
+                                       msg.idnum):
+                errors.append('invalid placement {!r}'.format(msg))
+                continue
+            positionupdates, _ = board.do_player_movement_at(
+                msg.x, msg.y, live_idnums)
+            expected.extend(positionupdates)
+
+        elif isinstance(msg, tiles.MessageMoveToken):
+            if expected:
+                move = expected.popleft()
+                if move != msg:
+                    errors.append('moved to {!r} instead of {!r}'.format(
+                        move, msg))
+                continue
+            # Otherwise it is the starting position a player chose
+            if not board.set_player_start_position(
+                    msg.idnum, msg.x, msg.y, msg.position):
+                errors.append('invalid start position {!r}'.format(msg))
+                continue
+            positionupdates, _ = board.do_player_movement_at(
+                msg.x, msg.y, live_idnums)
+            expected.extend(positionupdates)
+
+        elif isinstance(msg, tiles.MessagePlayerEliminated):
+            live_idnums.discard(msg.idnum)
+
+    if expected:
+        errors.append('{} token moves missing from the log'.format(
+            len(expected)))
+    return errors
+
+
+# Returns the number of games in a mapped log, a Counter of messages by type
+# and a Counter of the tiles placed. Games are decoded into columns with
+# tiles.decode_columns, so no message objects are made.
+def log_stats(buffer):
+    games = 0
+    messages = collections.Counter()
+    placed = collections.Counter()
+
+    for _, _, _, payload, _ in read_games(buffer):
+        games += 1
+        columns, _ = tiles.decode_columns(payload)
+        for msgtype, column in columns.items():
+            messages[msgtype] += len(column['offset'])
+        placetile = columns.get(tiles.MessageType.PLACE_TILE)
+        if placetile:
+            placed.update(placetile['tileid'])
+
+    return games, messages, placed
+
+
+def print_stats(buffer):
+    start = time.perf_counter()
+    games, messages, placed = log_stats(buffer)
+    elapsed = time.perf_counter() - start
+
+    total = sum(messages.values())
+    print('{} games, {} messages read in {:.2f} s ({:.0f} messages/s)'.format(
+        games, total, elapsed, total / elapsed if elapsed else 0))
+    for msgtype, count in sorted(messages.items()):
+        print('  {:<20} {:>10} {:>8.1f} per game'.format(
+            msgtype.name.lower(), count, count / games))
+    print('tiles placed')
+    for tileid, count in sorted(placed.items()):
+        print('  tile {:<3} {:>10}'.format(tileid, count))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a game log through tiles.Board.')
+    parser.add_argument('path', nargs='?', default='games.log')
+    parser.add_argument('--show', type=int, default=None,
+                        help='print the messages of this game')
+    parser.add_argument('--stats', action='store_true',
+                        help='count the messages and tiles in the log')
+    args = parser.parse_args()
+
+    board = tiles.Board()
+    games = 0
+    failed = 0
+    unfinished = 0
+
+    with open(args.path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if args.stats:
+            print_stats(buffer)
+            return
+
+        start = time.perf_counter()
+        for gameid, opened, seed, payload, ended in read_games(buffer):
+            if args.show is not None:
+                if gameid == args.show:
+                    print('game {} opened {} seed {}{}'.format(
+                        gameid, time.ctime(opened), seed,
+                        '' if ended else ', did not end'))
+                    for msg in read_messages(payload):
+                        print('  {!r}'.format(msg))
+                continue
+
+            games += 1
+            if not ended:
+                unfinished += 1
+            try:
+                errors = replay_game(board, payload)
+            except (IndexError, KeyError, ValueError) as e:
+                errors = ['corrupt record ({!r})'.format(e)]
+            if errors:
+                failed += 1
+                print('game {}: {}'.format(gameid, '; '.join(errors[:3])))
+        elapsed = time.perf_counter() - start
+
+    if args.show is None:
+        print('{} games replayed in {:.2f} s ({:.0f} games/s)'.format(
+            games, elapsed, games / elapsed if elapsed else 0))
+        print('{} games differ from the log'.format(failed))
+        print('{} games did not end'.format(unfinished))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# Headless load generator for the tiles server.
+#
+# Opens many client connections from a single process with asyncio. Every
+# connection speaks the same tiles protocol as client.py: it plays a random
+# legal move whenever it is its turn and otherwise just follows the game it
+# is watching. At the end a report is printed with the connection rate, the
+# time the server took to answer each move, games completed per second and
+# bytes received per game.
+#
+# Usage: python loadgen.py [host] [--clients N] [--duration SEC] [--ramp N]
+
+import argparse
+import asyncio
+import random
+import time
+import tiles
+
+
+class Stats:
+    # Counters shared by every bot of a run
+
+    def __init__(self):
+        self.connected = 0          # Connections that got their welcome
+        self.failed = 0             # Connections that could not be opened
+        self.closed = 0             # Connections closed by the server
+        self.connect_times = []     # Seconds from run start to each welcome
+        self.latencies = []         # Seconds from sending a move to its echo
+        self.moves = 0              # Moves sent by the bots
+        self.games = 0.0            # Games completed, see Bot.game_over()
+        self.bytes_in = 0           # Bytes received by all bots
+        self.messages_in = 0        # Messages received by all bots
+
+    # Returns the p-th percentile of a sorted list
+    @staticmethod
+    def percentile(values, p):
+        if not values:
+            return 0.0
+        index = min(len(values) - 1, int(len(values) * p / 100))
+        return values[index]
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        if self.connect_times:
+            connect_span = max(self.connect_times) or elapsed
+            connect_rate = self.connected / connect_span
+        else:
+            connect_rate = 0.0
+
+        print('duration         {:.1f} s'.format(elapsed))
+        print('connections      {} ok, {} failed, {} closed by server'.format(
+            self.connected, self.failed, self.closed))
+        print('connection rate  {:.1f} /s'.format(connect_rate))
+        print('moves            {} sent, {} answered'.format(
+            self.moves, len(latencies)))
+        print('move latency     p50 {:.2f} ms  p90 {:.2f} ms  '
+              'p99 {:.2f} ms  max {:.2f} ms'.format(
+                  self.percentile(latencies, 50) * 1000,
+                  self.percentile(latencies, 90) * 1000,
+                  self.percentile(latencies, 99) * 1000,
+                  (latencies[-1] if latencies else 0.0) * 1000))
+        print('games completed  {:.1f} ({:.2f} /s)'.format(
+            self.games, self.games / elapsed))
+        if self.games:
+            print('bytes per game   {:.0f}'.format(self.bytes_in / self.games))
+        print('received         {} messages, {} bytes'.format(
+            self.messages_in, self.bytes_in))
+
+
+class Bot:
+    # A single headless client. It keeps its own copy of the board, the same
+    # way client.py does, so that it can choose legal moves.
+
+    def __init__(self, stats, think=0.0):
+        self.stats = stats
+        self.think = think          # Seconds to wait before moving
+        self.writer = None
+        self.idnum = None
+        self.board = tiles.Board()
+        self.hand = []
+        self.start_pos = None       # Square of this bot's first tile
+        self.seated = False         # True while playing in a game
+        self.turn_ids = set()       # Players seen taking a turn this game
+        self.eliminated = set()
+        self.move_sent = None       # When the last move was sent
+        self.pending_move = None    # Task waiting to make the next move
+
+    # Resets the game state when a new game starts
+    def new_game(self):
+        self.board.reset()
+        self.hand = []
+        self.start_pos = None
+        self.seated = False
+        self.turn_ids = set()
+        self.eliminated = set()
+        self.move_sent = None
+
+    # Called when no more than one player of the game is left. Each player
+    # counts 1 / players of a completed game, so the sum over all bots is the
+    # number of games.
+    def game_over(self):
+        if self.seated and self.turn_ids:
+            self.stats.games += 1 / len(self.turn_ids)
+        self.seated = False
+
+    # Picks a random legal move for the current turn
+    def choose_move(self):
+        board = self.board
+        idnum = self.idnum
+        tileid = random.choice(self.hand)
+        rotation = random.randint(0, 3)
+
+        # Second turn: enter the board from the first tile
+        if self.start_pos is not None and \
+                not board.have_player_position(idnum):
+            x, y, position = random.choice(board.legal_start_positions(idnum))
+            return tiles.MessageMoveToken(idnum, x, y, position)
+
+        # Other turns: where the token is, or any free edge square at first
+        x, y = random.choice(board.legal_tile_squares(idnum))
+        return tiles.MessagePlaceTile(idnum, tileid, rotation, x, y)
+
+    async def make_move(self):
+        if self.think:
+            await asyncio.sleep(self.think)
+        if not self.hand or self.writer is None:
+            return
+        msg = self.choose_move()
+        self.move_sent = time.monotonic()
+        self.stats.moves += 1
+        self.writer.write(msg.pack())
+
+    # Records the time the server took to accept this bot's move
+    def move_answered(self):
+        if self.move_sent is not None:
+            self.stats.latencies.append(time.monotonic() - self.move_sent)
+            self.move_sent = None
+
+    def handle_message(self, msg):
+        board = self.board
+
+        if isinstance(msg, tiles.MessageWelcome):
+            self.idnum = msg.idnum
+
+        elif isinstance(msg, tiles.MessageGameStart):
+            self.new_game()
+
+        elif isinstance(msg, tiles.MessageAddTileToHand):
+            # Only players are dealt tiles
+            self.seated = True
+            self.hand.append(msg.tileid)
+
+        elif isinstance(msg, tiles.MessagePlayerTurn):
+            self.turn_ids.add(msg.idnum)
+            if msg.idnum == self.idnum and self.seated:
+                self.pending_move = asyncio.ensure_future(self.make_move())
+
+        elif isinstance(msg, tiles.MessagePlaceTile):
+            # Trust the server, the same way the client does
+            idx = board.tile_index(msg.x, msg.y)
+            board.tileids[idx] = msg.tileid
+            board.tilerotations[idx] = msg.rotation
+            board.tileplaceids[idx] = msg.idnum
+            if msg.idnum == self.idnum:
+                self.move_answered()
+                if msg.tileid in self.hand:
+                    self.hand.remove(msg.tileid)
+                if self.start_pos is None:
+                    self.start_pos = (msg.x, msg.y)
+
+        elif isinstance(msg, tiles.MessageMoveToken):
+            if msg.idnum == self.idnum and \
+                    not board.have_player_position(self.idnum):
+                self.move_answered()
+            board.update_player_position(msg.idnum, msg.x, msg.y, msg.position)
+
+        elif isinstance(msg, tiles.MessagePlayerEliminated):
+            self.eliminated.add(msg.idnum)
+            if len(self.turn_ids - self.eliminated) <= 1:
+                self.game_over()
+
+    async def run(self, host, port, until, started):
+        stats = self.stats
+        try:
+            reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            stats.failed += 1
+            return
+
+        decoder = tiles.MessageDecoder()
+        welcomed = False
+        try:
+            while True:
+                remaining = until - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    data = await asyncio.wait_for(
+                        reader.read(65536), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not data:
+                    stats.closed += 1
+                    break
+
+                stats.bytes_in += len(data)
+                decoder.feed(data)
+                for msg in decoder:
+                    stats.messages_in += 1
+                    if not welcomed and isinstance(msg, tiles.MessageWelcome):
+                        welcomed = True
+                        stats.connected += 1
+                        stats.connect_times.append(time.monotonic() - started)
+                    self.handle_message(msg)
+        except OSError:
+            stats.closed += 1
+        finally:
+            if self.pending_move is not None:
+                self.pending_move.cancel()
+            self.writer.close()
+
+
+async def swarm(host, port, clients, duration, ramp, think):
+    stats = Stats()
+    started = time.monotonic()
+    until = started + duration
+
+    tasks = []
+    for i in range(clients):
+        bot = Bot(stats, think)
+        tasks.append(asyncio.ensure_future(bot.run(host, port, until, started)))
+        # Spreads the connections out if a ramp rate was given
+        if ramp:
+            await asyncio.sleep(1 / ramp)
+
+    await asyncio.gather(*tasks)
+    stats.report(time.monotonic() - started)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Headless bot swarm for load testing the tiles server.')
+    parser.add_argument('host', nargs='?', default='localhost')
+    parser.add_argument('--port', type=int, default=30020)
+    parser.add_argument('--clients', type=int, default=100,
+                        help='number of connections to open')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--ramp', type=float, default=0,
+                        help='connections opened per second, 0 for all at once')
+    parser.add_argument('--think', type=float, default=0,
+                        help='seconds each bot waits before moving')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(swarm(args.host, args.port, args.clients, args.duration,
+                      args.ramp, args.think))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# Counters and histograms kept by the server, written out in the Prometheus
+# text format.
+#
+# Updating a metric is a few additions, so they can be updated on every turn
+# and every message. Each metric is only updated from one thread, or with
+# the server lock held.
+
+import bisect
+import collections
+import os
+import tiles
+
+
+# Upper bounds of the histogram buckets
+TIME_BUCKETS = (0.00001, 0.00003, 0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03,
+                0.1, 0.3, 1, 3, 10, 30)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+GAME_BUCKETS = (1, 3, 10, 30, 60, 120, 300, 600, 1800)
+
+# Label used for the catch-up sent to new spectators, which holds many
+# messages in one send
+CATCH_UP = 'catch_up'
+
+
+class Histogram:
+    # Counts observed values in buckets with the given upper bounds
+
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # The last one is +Inf
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    # Lines of the Prometheus text format, with cumulative buckets
+    def render(self, name):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(
+                name, bound, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append('{}_sum {}'.format(name, self.total))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+
+class Summary:
+    # Keeps the last window observed values, to report their quantiles,
+    # along with the count and sum of every value
+
+    __slots__ = ('recent', 'total', 'count')
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=1000):
+        self.recent = collections.deque(maxlen=window)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.recent.append(value)
+        self.total += value
+        self.count += 1
+
+    # Quantile q of the recent values, or 0 if there are none
+    def quantile(self, q):
+        if not self.recent:
+            return 0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    # Lines of the Prometheus text format
+    def render(self, name):
+        lines = []
+        for q in self.QUANTILES:
+            lines.append('{}{{quantile="{}"}} {}'.format(
+                name, q, self.quantile(q)))
+        lines.append('{}_sum {}'.format(name, self.total))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+
+# Name of a message type for labels
+def type_label(msgtype):
+    if msgtype == CATCH_UP:
+        return CATCH_UP
+    try:
+        return tiles.MessageType(msgtype).name.lower()
+    except ValueError:
+        return 'unknown'
+
+
+class Metrics:
+    # Every metric the server keeps
+
+    def __init__(self):
+        # Seconds from a PlayerTurn to the player's valid move
+        self.turn_latency = Histogram(TIME_BUCKETS)
+        # Seconds taken by Game.broadcast, and clients it sent to
+        self.broadcast_time = Histogram(TIME_BUCKETS)
+        self.broadcast_recipients = Histogram(COUNT_BUCKETS)
+        # Seconds taken by token movement after each move
+        self.movement_time = Histogram(TIME_BUCKETS)
+        # Turns and seconds each finished game lasted
+        self.game_turns = Histogram(COUNT_BUCKETS)
+        self.game_duration = Histogram(GAME_BUCKETS)
+        # Seconds clients waited in the lobby for a table
+        self.queue_wait = Summary()
+        self.turns = 0              # Turns played
+        self.autoplays = 0          # Turns the server played for a player
+        self.games = 0              # Games finished
+        # Message type -> messages and bytes received and sent
+        self.messages_in = {}
+        self.bytes_in = {}
+        self.messages_out = {}
+        self.bytes_out = {}
+
+    def message_in(self, msg, size):
+        msgtype = msg.TYPE
+        self.messages_in[msgtype] = self.messages_in.get(msgtype, 0) + 1
+        self.bytes_in[msgtype] = self.bytes_in.get(msgtype, 0) + size
+
+    # message is packed, so its type is in the first two bytes
+    def message_out(self, message, msgtype=None):
+        if msgtype is None:
+            msgtype = message[1]
+        self.messages_out[msgtype] = self.messages_out.get(msgtype, 0) + 1
+        self.bytes_out[msgtype] = self.bytes_out.get(msgtype, 0) + len(message)
+
+    # Returns every metric in the Prometheus text format. gauges is a dict
+    # of name -> current value, for values the server counts itself.
+    def render(self, gauges):
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP tiles_{} {}'.format(name, help))
+            lines.append('# TYPE tiles_{} {}'.format(name, kind))
+
+        for name, value in sorted(gauges.items()):
+            metric(name, 'gauge', 'Current number of {}.'.format(
+                name.replace('_', ' ')))
+            lines.append('tiles_{} {}'.format(name, value))
+
+        for name, value, help in (
+                ('turns_total', self.turns, 'Turns played.'),
+                ('autoplays_total', self.autoplays,
+                 'Turns played by the server after a timeout.'),
+                ('games_total', self.games, 'Games finished.')):
+            metric(name, 'counter', help)
+            lines.append('tiles_{} {}'.format(name, value))
+
+        for name, counts, help in (
+                ('messages_in_total', self.messages_in, 'Messages received.'),
+                ('bytes_in_total', self.bytes_in, 'Bytes received.'),
+                ('messages_out_total', self.messages_out, 'Messages sent.'),
+                ('bytes_out_total', self.bytes_out, 'Bytes sent.')):
+            metric(name, 'counter', help + ' by message type')
+            for msgtype, value in sorted(
+                    counts.items(), key=lambda item: str(item[0])):
+                lines.append('tiles_{}{{type="{}"}} {}'.format(
+                    name, type_label(msgtype), value))
+
+        for name, histogram, help in (
+                ('turn_latency_seconds', self.turn_latency,
+                 'Seconds from a turn starting to the player\'s valid move.'),
+                ('broadcast_seconds', self.broadcast_time,
+                 'Seconds taken to queue a broadcast.'),
+                ('broadcast_recipients', self.broadcast_recipients,
+                 'Clients each broadcast was queued for.'),
+                ('movement_seconds', self.movement_time,
+                 'Seconds taken by token movement after a move.'),
+                ('game_turns', self.game_turns, 'Turns in each finished game.'),
+                ('game_duration_seconds', self.game_duration,
+                 'Seconds each finished game lasted.')):
+            metric(name, 'histogram', help)
+            lines.extend(histogram.render('tiles_' + name))
+
+        metric('queue_wait_seconds', 'summary',
+               'Seconds clients waited in the lobby for a table, quantiles '
+               'over the last {}.'.format(self.queue_wait.recent.maxlen))
+        lines.extend(self.queue_wait.render('tiles_queue_wait_seconds'))
+
+        return '\n'.join(lines) + '\n'
+
+    # Writes the metrics to path. The file is replaced in one step, so a
+    # reader never sees half of it.
+    def write(self, path, gauges):
+        text = self.render(gauges)
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, path)
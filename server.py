@@ -2,6 +2,7 @@
 # Tested on Windows 10 only
 
 import socket
+import selectors
 import sys
 import threading
 from tkinter.constants import X
@@ -9,417 +10,1149 @@ import tiles
 import random
 import time
 import queue
-from tiles import BOARD_HEIGHT
+import heapq
+import collections
+import itertools
+import gamelog
+import metrics
+import tracing
+import signal
+import os
+import argparse
+import multiprocessing
+import enum
+import traceback
 
 
-class Server:
-    COUNT_DOWN = 2          # Count down for a new game
-    WAIT_CONNECTIONS = 1    # Server checks for connection to start game
-    WAIT_PLAYERS = 1        # If connection, server waits for few more players
-    WAIT_MOVE = 10          # Wait time for server to place a tile instead
+class GameState(enum.Enum):
+    # The stages a table goes through, in order. A table whose players have
+    # all left during the count down skips straight to FINISHED.
+    WAITING = 'waiting'         # Players picked, not told yet
+    COUNTDOWN = 'countdown'     # Players introduced, game starts at a timer
+    DEALING = 'dealing'         # Game started, hands being dealt
+    PLAYING = 'playing'         # Turns being played
+    FINISHED = 'finished'       # Over, players going back to the lobby
 
-    def __init__(self, host, port):
-        self.sock = None
-        self.host = host
-        self.port = port
+
+class Game:
+    # A single table. Each game owns its own board, turn order, hands and
+    # history, and runs on its own thread so that many tables can be played
+    # at the same time. Clients watching the table are kept in the audience
+    # together with the players.
+
+    def __init__(self, server, gameid, players):
+        self.server = server
+        self.gameid = gameid
         self.board = tiles.Board()
-        self.idnum_counter = -1
-        self.connections = []       # Stores all connected clients
-        self.players = []           # Stores players currently in game
-        self.live_idnums = []       # Stores idnumber of the players in game
-        self.eliminated = []        # Stores the eliminated players
-        self.tiles_placed = []      # Keeps track of all tile placements
-        self.position_updates = []  # keeps track of position updates
-        self.game_running = False   # True if a game is currently running
+        self.players = {}           # idnum -> players currently in game
+        self.live_idnums = set()    # Stores idnumber of the players in game
+        self.eliminated = []        # Stores the eliminated players, in order
+        # idnum -> players and spectators of the table
+        self.audience = {player.idnum: player for player in players}
+        self.hands = {}             # idnum -> tiles in the player's hand
+        self.turns = {}             # idnum -> player specific hand turn
+        self.snapshot = None        # Packed catch-up for new spectators
+        self.state = GameState.WAITING
+        self.countdown_timer = None # Ends the count down
         self.curr_player = None     # Stores the current player turn
+        self.turn_number = 0        # Counts turns, to spot stale timeouts
         self.turn_queue = queue.Queue(tiles.PLAYER_LIMIT)   # Player turn queue
+        self.events = queue.Queue()     # (client, msg) from the I/O thread
+        # Every random choice of the game comes from its own seeded generator
+        self.seed = random.getrandbits(64)
+        self.rng = random.Random(self.seed)
+        self.opened = time.time()   # When the table was made, for the log
+        self.started = None         # time.time() when the game started
+        self.history = []           # Packed messages not yet in the log
+        self.departed = []          # idnums of players who have disconnected
 
-    # Checks if a selected token position is valid
-    # Copied from tiles.py. Used when the server is doing the move.
-    def valid_token_move(self, x, y, position):
-        if (position == 0 or position == 1) and y != BOARD_HEIGHT - 1:
-            return False
-        if (position == 2 or position == 3) and x != BOARD_HEIGHT - 1:
-            return False
-        if (position == 4 or position == 5) and y != 0:
-            return False
-        if (position == 6 or position == 7) and x != 0:
-            return False
-        return True
-
-    # Selects the x, y position of first tile
-    # It is called again if x, y position returned is already taken
-    # Used when the server is doing the move
-    def first_tile_xy(self):
-        x = random.randint(0, 4)
-        y = 0
-        if x == 0 or x == 4:
-            y = random.randint(0, 4)
-        else:
-            y = random.choice([0, 4])
-        return (x, y)
+        # Each selected player is added to turn queue and live_idnums
+        self.seated = list(players)     # Every player, in turn order
+        self.rng.shuffle(self.seated)
+        for player in self.seated:
+            idnum = player.idnum
+            self.players[idnum] = player
+            self.turn_queue.put(player)
+            self.live_idnums.add(idnum)
+            self.hands[idnum] = []
+            self.turns[idnum] = 1
 
-    # If player does not make a move, server will do the movement
-    # Function returns a 'chunk' of data similar to what clients send
+    # If player does not make a move, server will do the movement.
+    # Each legal move is tried on a copy of the board, in random order, until
+    # one leaves every token on the board. Failing that, the move eliminating
+    # the fewest players is used, preferring moves the player survives. The
+    # search stops after AUTOPLAY_BUDGET seconds of CPU time with the best
+    # move found so far.
+    # Function returns the move as a message, as if the player had sent it,
+    # or None if the player has no legal move
     def do_player_move(self, player):
-        # first move for each player, Placing a tile
-        if player["turn"] == 1:
-            # Other players first moves are added to this list
-            # So that a selected x, y position does not overlap
-            tiles_on_board = []
-            for p in self.players:
-                if p["start_pos"] == None:
-                    continue
-                tiles_on_board.append(p["start_pos"])
-            (x, y) = self.first_tile_xy()
-            while (x, y) in tiles_on_board:
-                (x, y) = self.first_tile_xy()
-
-            tileid = random.choice(player["hand"])
-            rotation = random.randint(0, 3)
-            player["start_pos"] = (x, y)
-
-            chunk = tiles.MessagePlaceTile(
-                player["idnum"], tileid, rotation, x, y).pack()
-            return chunk
-        # Second move for each player, token position
-        elif player["turn"] == 2:
-            idnum = player["idnum"]
-            x = player["start_pos"][0]
-            y = player["start_pos"][1]
-
-            # Keeps looking for a valid token position
-            position = random.randint(0, 7)
-            while not self.valid_token_move(x, y, position):
-                position = random.randint(0, 7)
-
-            chunk = tiles.MessageMoveToken(idnum, x, y, position).pack()
-            return chunk
-        else:
-            # Subsequent moves for each player
-            x, y, position = self.board.get_player_position(player["idnum"])
+        idnum = player.idnum
+        live_idnums = list(self.live_idnums)
+        deadline = time.thread_time() + self.server.AUTOPLAY_BUDGET
 
-            tileid = random.choice(player["hand"])
-            rotation = random.randint(0, 3)
+        best = None
+        best_score = None
+        for msg in self.legal_moves(idnum):
+            board = self.board.copy()
+            if isinstance(msg, tiles.MessageMoveToken):
+                board.set_player_start_position(
+                    idnum, msg.x, msg.y, msg.position)
+            else:
+                board.set_tile(msg.x, msg.y, msg.tileid, msg.rotation, idnum)
+            _, eliminated = board.do_player_movement_at(
+                msg.x, msg.y, live_idnums)
 
-            chunk = tiles.MessagePlaceTile(
-                player["idnum"], tileid, rotation, x, y).pack()
-            return chunk
+            score = (idnum in eliminated, len(eliminated))
+            if best is None or score < best_score:
+                best = msg
+                best_score = score
+            if not score[1] or time.thread_time() >= deadline:
+                break
 
-    # Processes client disconection
-    def disconnect_client(self, client):
-        print('client {} disconnected'.format(client["addr"]))
-        if client in self.players:
-            self.connections.remove(client)
-            idnum = client["idnum"]
-            self.eliminate_player([idnum])
-            self.broadcast(tiles.MessagePlayerLeft(idnum).pack())
-        # If player not currently in a game
+        return best
+
+    # Every move the player can make this turn, in random order
+    def legal_moves(self, idnum):
+        # Second move for each player, token position
+        if self.turns[idnum] == 2:
+            moves = [tiles.MessageMoveToken(idnum, x, y, position)
+                     for x, y, position
+                     in self.board.legal_start_positions(idnum)]
+        # Other moves place a tile from the hand, any free edge square on the
+        # first move and the square the token is entering after that
         else:
-            self.connections.remove(client)
-            self.broadcast(tiles.MessagePlayerLeft(client["idnum"]).pack())
+            moves = [tiles.MessagePlaceTile(idnum, tileid, rotation, x, y)
+                     for x, y in self.board.legal_tile_squares(idnum)
+                     for tileid in set(self.hands[idnum])
+                     for rotation in range(4)]
+        self.rng.shuffle(moves)
+        return moves
+
+    # Called by the server when a client of this table disconnects
+    def remove_client(self, client):
+        self.audience.pop(client.idnum, None)
+        if client.idnum in self.players:
+            self.eliminate_player([client.idnum])
+        self.broadcast(tiles.MessagePlayerLeft(client.idnum).pack())
+        # Wakes the game thread in case it is waiting on this client
+        self.events.put((client, None))
 
     # For each player in the eliminated list given, player is eliminated
     def eliminate_player(self, eliminated):
         for idnum in eliminated:
-            # Additional for loop because I store players as well as live_idnums
-            for player in self.players:
-                if player["idnum"] == idnum:
-                    self.players.remove(player)
-                    self.eliminated.append(player)
+            player = self.players.pop(idnum, None)
+            if player is not None:
+                self.eliminated.append(player)
             self.live_idnums.remove(idnum)
             self.broadcast(tiles.MessagePlayerEliminated(idnum).pack())
 
+    # Waits for the current player's move. Messages arrive already decoded from
+    # the I/O thread, as does (None, turn) when the turn's deadline passes.
+    # Moves from other clients are ignored and disconnects are processed as
+    # soon as they are seen. Returns the move and whether the server made it,
+    # or None, False if the player left. The server's move is None if it
+    # found none.
+    def next_move(self, player, turn):
+        while True:
+            client, msg = self.events.get()
+
+            if client is None:
+                # Deadline of a turn that has already been played
+                if msg != turn:
+                    continue
+                # If player doesn't make a move, server will do the move instead.
+                # The board and hands are only changed by this thread, so the
+                # move is chosen without holding the server lock.
+                print(f"Player [{player.idnum}] timedout.")
+                print("Server will do player's move.")
+                msg = self.do_player_move(player)
+                with self.server.lock:
+                    self.server.metrics.autoplays += 1
+                return msg, True
+
+            # Disconnected client has already been processed by the server
+            if msg is None:
+                if client is player:
+                    return None, False
+                continue
+
+            # Messages sent out of turn are ignored
+            if client is player:
+                return msg, False
+
     # Called from handle_game() function when it gets the next player turn from
-    # the queue. It calls handle_player() and passes the current player turn to it.
-    # Handles most of the game logic for the player.
+    # the queue. The turn has a single deadline, kept by the server's
+    # scheduler, and the player's messages are played until one is a valid
+    # move. An invalid move does not give the player more time.
     def handle_player(self, player):
-        buffer = bytearray()
-        conn = player["conn"]
-        idnum = player["idnum"]
+        self.turn_number += 1
+        turn = self.turn_number
+        started = time.perf_counter()
+        deadline = time.monotonic() + self.server.WAIT_MOVE
+        timer = self.server.set_timer(
+            deadline, lambda: self.events.put((None, turn)))
 
-        conn.settimeout(self.WAIT_MOVE)
         try:
-            chunk = conn.recv(4096)
-            # If player doesn't make a move, server will do the move instead.
-        except:
-            print(f"Player [{idnum}] timedout.")
-            print("Server will do player's move.")
-            chunk = self.do_player_move(player)
-
-        # Disconnected player is processed
-        if not chunk:
-            self.disconnect_client(player)
-            return
+            while True:
+                msg, autoplayed = self.next_move(player, turn)
+                # The player left
+                if msg is None and not autoplayed:
+                    return
+                # A player left without a legal move is out of the game
+                if msg is None:
+                    print(f"Player [{player.idnum}] has no legal move and "
+                          "is eliminated.")
+                    with self.server.lock:
+                        self.eliminate_player([player.idnum])
+                    return
+                if self.play_move(player, msg):
+                    with self.server.lock:
+                        stats = self.server.metrics
+                        stats.turns += 1
+                        if not autoplayed:
+                            stats.turn_latency.observe(
+                                time.perf_counter() - started)
+                    return
+                # After the deadline the timer's event is still queued, and
+                # the server moves for the player when it is reached
+        finally:
+            self.server.cancel_timer(timer)
 
-        buffer.extend(chunk)
-        while True:
-            msg, consumed = tiles.read_message_from_bytearray(buffer)
-            if not consumed:
-                break
+    # Handles most of the game logic for the player.
+    # Returns False if the move was invalid and the player must try again.
+    def play_move(self, player, msg):
+        idnum = player.idnum
+        retry = False
+
+        with self.server.lock:
+            # The player may have left while the move was being decided
+            if not player.connected:
+                return True
 
-            buffer = buffer[consumed:]
             print('received message {}'.format(msg))
 
+            # The second turn chooses where the token starts, every other
+            # turn places a tile. Anything else is rejected like a bad move.
+            expected = (tiles.MessageMoveToken if self.turns[idnum] == 2
+                        else tiles.MessagePlaceTile)
+            if not isinstance(msg, expected) or msg.idnum != idnum:
+                print(f"Unexpected message. Player[{idnum}] must try again.")
+                return False
+
             # sent by the player to put a tile onto the board
             #  (in all turns except their second)
             if isinstance(msg, tiles.MessagePlaceTile):
-                if self.board.set_tile(
+                if msg.tileid in self.hands[idnum] and self.board.set_tile(
                         msg.x, msg.y, msg.tileid, msg.rotation, msg.idnum):
 
                     # Notify client that placement was successful
-                    # In this implementation I decided not to run client threads,
-                    # Simultaneously. So, the only way I can detect if a client is
-                    # disconnected is when there is an exception error when server
-                    # is trying to send a message to each client. That is when,
-                    # server detects a client has been disconnected. A disconnected
-                    # client is also detected when its their turn through 'not chunk'.
-                    # broadcast() returns the disconnected player.
-                    dc = self.broadcast(msg.pack())
-                    if dc == player:
-                        return
-
-                    # Server stores each players start position. It was needed
-                    # so that when server is doing the first move automatically,
-                    # it does not place a tile over another players' tile.
-                    if player["start_pos"] == None:
-                        player["start_pos"] = (msg.x, msg.y)
+                    self.broadcast(msg.pack())
 
-                    # check for token movement
-                    positionupdates, eliminated = self.board.do_player_movement(
-                        self.live_idnums)
+                    # check for token movement, only tokens on the square that
+                    # just received the tile can move
+                    positionupdates, eliminated = self.move_tokens(msg.x, msg.y)
 
                     for message in positionupdates:
-                        dc = self.broadcast(message.pack())
-                        if dc == player:
-                            return
-                        # Keeping track of position updates
-                        self.position_updates.append(message.pack())
+                        self.broadcast(message.pack())
 
-                    if idnum in eliminated:
+                    # Other players pushed off the board are eliminated too
+                    if eliminated:
                         self.eliminate_player(eliminated)
-                        return
+                    if idnum in eliminated:
+                        return True
 
-                    # Keeping track of tile placements
-                    self.tiles_placed.append(msg.pack())
                     # Remove the tile used from hand
-                    player["hand"].remove(msg.tileid)
+                    self.hands[idnum].remove(msg.tileid)
                     # Pick up a new tile
-                    tileid = tiles.get_random_tileid()
-                    player["hand"].append(tileid)
-                    conn.send(tiles.MessageAddTileToHand(tileid).pack())
+                    tileid = tiles.get_random_tileid(self.rng)
+                    self.hands[idnum].append(tileid)
+                    self.server.send(
+                        player, tiles.ADD_TILE_TO_HAND_MESSAGES[tileid].pack())
 
-                # If player sends an invalid chunk, function is recursively called
-                # again. Not the best implementation, but it works.
+                # If player sends an invalid chunk, the player must try again
+                # before the same deadline.
                 else:
                     print(
                         f"Inavlid tile placement. Player[{idnum}] must try again.")
-                    self.handle_player(player)
-                    return
+                    retry = True
 
             # sent by the player in the second turn, to choose their token's
             # starting path
             elif isinstance(msg, tiles.MessageMoveToken):
-                if not self.board.have_player_position(msg.idnum):
-                    if self.board.set_player_start_position(
+                if not self.board.have_player_position(msg.idnum) and \
+                        self.board.set_player_start_position(
                             msg.idnum, msg.x, msg.y, msg.position):
-                        # check for token movement
-                        positionupdates, eliminated = self.board.do_player_movement(
-                            self.live_idnums)
+                    # Only the log is told the chosen start position
+                    self.history.append(msg.pack())
+                    # check for token movement
+                    positionupdates, eliminated = self.move_tokens(
+                        msg.x, msg.y)
 
-                        for message in positionupdates:
-                            dc = self.broadcast(message.pack())
-                            if dc == player:
-                                break
-                            # Keeping track of position updates
-                            self.position_updates.append(message.pack())
+                    for message in positionupdates:
+                        self.broadcast(message.pack())
+
+                    if idnum in eliminated:
+                        self.eliminate_player(eliminated)
+                        return True
 
-                        if idnum in eliminated:
-                            self.eliminate_player(eliminated)
-                            return
+                # A start position that is not allowed is tried again too
+                else:
+                    print(
+                        f"Invalid start position. Player[{idnum}] must try again.")
+                    retry = True
 
             # Incrementing player specific hand turn
-            player["turn"] += 1
+            if not retry:
+                self.turns[idnum] += 1
+
+        return not retry
+
+    # Moves the tokens on the square x, y after a move, and records how long
+    # it took. Returns positionupdates, eliminated from the board.
+    def move_tokens(self, x, y):
+        start = time.perf_counter()
+        result = self.board.do_player_movement_at(x, y, self.live_idnums)
+        self.server.metrics.movement_time.observe(time.perf_counter() - start)
+        return result
+
+    # WAITING: everyone at the table is introduced to the players and the
+    # count down starts. A timer ends it exactly COUNT_DOWN seconds later.
+    def introduce(self):
+        for player in self.seated:
+            self.broadcast(tiles.MessagePlayerJoined(
+                player.name, player.idnum).pack())
+        self.broadcast(tiles.COUNTDOWN_MESSAGE.pack())
+        self.server.flush()
+        print(f"Game {self.gameid} will start in "
+              f"{self.server.COUNT_DOWN} seconds...")
+        self.countdown_timer = self.server.set_timer(
+            time.monotonic() + self.server.COUNT_DOWN,
+            lambda: self.events.put((None, GameState.COUNTDOWN)))
+        return GameState.COUNTDOWN
 
-    # Servers' main game loop. Called from start_game() function.
-    # Gives each selected player random tiles.
+    # COUNTDOWN: waits for the count down's timer. Messages sent meanwhile
+    # are ignored, and the table is given up if every player leaves.
+    def count_down(self):
+        while True:
+            client, msg = self.events.get()
+            if client is None and msg is GameState.COUNTDOWN:
+                return GameState.DEALING
+            if not self.live_idnums:
+                self.server.cancel_timer(self.countdown_timer)
+                print(f"Game {self.gameid} has no players left.")
+                return GameState.FINISHED
+
+    # DEALING: the game starts and each player is given random tiles
+    def deal(self):
+        with self.server.lock:
+            self.started = time.time()
+            self.broadcast(tiles.GAME_START_MESSAGE.pack())
+            for player in list(self.players.values()):
+                for _ in range(tiles.HAND_SIZE):
+                    tileid = tiles.get_random_tileid(self.rng)
+                    # Keeping track of each player's hand
+                    self.hands[player.idnum].append(tileid)
+                    self.server.send(
+                        player, tiles.ADD_TILE_TO_HAND_MESSAGES[tileid].pack())
+        print(f"Game {self.gameid} starts.")
+        return GameState.PLAYING
+
+    # PLAYING: the game's main loop.
     # Constantly get the next player from the queue.
     def handle_game(self):
-        # Adding tiles to hand for each player
-        for player in self.players:
-            for _ in range(tiles.HAND_SIZE):
-                tileid = tiles.get_random_tileid()
-                # Keeping track of each player's hand
-                player["hand"].append(tileid)
-                player["conn"].send(tiles.MessageAddTileToHand(tileid).pack())
-
         # Game runs until there is only 1 player left.
-        while True:
+        while self.live_idnums:
             self.curr_player = self.turn_queue.get()
-            idnum = self.curr_player["idnum"]
+            idnum = self.curr_player.idnum
             # If the player received from the queue has been previously disconnected,
             # or eliminated, it is ignored, so we get the next in queue.
             while idnum not in self.live_idnums:
                 self.curr_player = self.turn_queue.get()
-                idnum = self.curr_player["idnum"]
+                idnum = self.curr_player.idnum
 
+            # The results of the last move go out together with the new turn
             self.broadcast(tiles.MessagePlayerTurn(idnum).pack())
+            self.server.flush()
             self.handle_player(self.curr_player)
+            self.log_events()
 
             # After handle_player() returns, the current player might have been
             # eliminated. So we should not put it back into the queue.
-            if self.curr_player not in self.eliminated:
+            if idnum in self.players:
                 self.turn_queue.put(self.curr_player)
 
             # Game is over in the below cases.
             if len(self.live_idnums) == 1 or len(self.live_idnums) == 0:
                 break
 
-        # Start the next game.
-        self.start_game()
+        return GameState.FINISHED
+
+    # FINISHED: a game that was played to the end is recorded, the table's
+    # log is ended and everyone at the table goes back to the lobby
+    def finish(self):
+        self.server.flush()
+        if self.started is not None and self.state is GameState.FINISHED:
+            with self.server.lock:
+                stats = self.server.metrics
+                stats.games += 1
+                stats.game_turns.observe(self.turn_number)
+                stats.game_duration.observe(time.time() - self.started)
+        self.log_events(end=True)
+        self.server.end_game(self)
+
+    # Runs the table through its states on the game thread, from the count
+    # down to the end of the game. Each state's method returns the next
+    # state. Waiting is done on the events queue, for a message or a timer.
+    # What the table broadcast is logged after every state. If a state
+    # fails the error is printed and the table is finished all the same, so
+    # its clients are not left at a dead table.
+    def run(self):
+        steps = {
+            GameState.WAITING: self.introduce,
+            GameState.COUNTDOWN: self.count_down,
+            GameState.DEALING: self.deal,
+            GameState.PLAYING: self.handle_game,
+        }
+        try:
+            while self.state is not GameState.FINISHED:
+                state = steps[self.state]()
+                with self.server.lock:
+                    self.state = state
+                self.log_events()
+        except Exception:
+            print(f"Game {self.gameid} failed in state {self.state.name}:")
+            traceback.print_exc()
+        finally:
+            self.finish()
+
+    # Hands the messages broadcast since the last call to the game log, so
+    # the log follows the game as it is played. end=True ends the game's log.
+    def log_events(self, end=False):
+        with self.server.lock:
+            events, self.history = self.history, []
+        self.server.log_events(self, b''.join(events), end)
+
+    # Queues a message for every player and spectator of this table
+    def broadcast(self, message):
+        with self.server.lock:
+            start = time.perf_counter()
+            # Anything broadcast changes what a new spectator must be sent
+            self.snapshot = None
+            self.history.append(message)
+            for client in self.audience.values():
+                self.server.send(client, message)
+            stats = self.server.metrics
+            stats.broadcast_time.observe(time.perf_counter() - start)
+            stats.broadcast_recipients.observe(len(self.audience))
+
+    # Returns the packed messages that bring a new spectator up to date.
+    # Only the current state is included: the players, who is out, the tiles
+    # on the board and where each token is now. It is built for the first
+    # spectator after a change and shared by every other one until the next
+    # broadcast.
+    def catch_up(self):
+        if self.snapshot is not None:
+            return self.snapshot
+
+        messages = []
+        for player in self.seated:
+            messages.append(tiles.MessagePlayerJoined(
+                player.name, player.idnum).pack())
+
+        if self.started is not None:
+            # All players are listed in turn order, so that they get the same
+            # colours as on the other clients
+            for player in self.seated:
+                messages.append(
+                    tiles.MessagePlayerTurn(player.idnum).pack())
+            for loser in self.eliminated:
+                messages.append(
+                    tiles.MessagePlayerEliminated(loser.idnum).pack())
+
+            board = self.board
+            for idx, tileid in enumerate(board.tileids):
+                if tileid is None:
+                    continue
+                y, x = divmod(idx, board.width)
+                messages.append(tiles.MessagePlaceTile(
+                    board.tileplaceids[idx], tileid, board.tilerotations[idx],
+                    x, y).pack())
+            for idnum, (x, y, position) in board.playerpositions.items():
+                messages.append(
+                    tiles.MessageMoveToken(idnum, x, y, position).pack())
+
+            if self.curr_player is not None:
+                messages.append(tiles.MessagePlayerTurn(
+                    self.curr_player.idnum).pack())
+
+        self.snapshot = b''.join(messages)
+        return self.snapshot
+
+
+class Scheduler:
+    # Turn deadlines of every table, in a heap ordered by time, so adding or
+    # firing a timer costs O(log n) however many turns are running. Timers
+    # are run by the I/O thread. A cancelled timer stays in the heap and is
+    # skipped, until cancelled timers make up half of it.
+
+    def __init__(self):
+        self.heap = []
+        self.counter = 0            # Keeps timers with equal deadlines in order
+        self.cancelled = 0          # Cancelled timers still in the heap
+        self.lock = threading.Lock()
+
+    # Schedules callback() for the given time.monotonic() deadline.
+    # Returns the timer, and whether it is now the first one due.
+    def schedule(self, deadline, callback):
+        with self.lock:
+            timer = [deadline, self.counter, callback]
+            self.counter += 1
+            heapq.heappush(self.heap, timer)
+            return timer, self.heap[0] is timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer[2] is None:
+                return
+            timer[2] = None
+            self.cancelled += 1
+            if self.cancelled * 2 > len(self.heap):
+                self.heap = [t for t in self.heap if t[2] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+
+    # Seconds until the next timer is due, or None if there are no timers
+    def timeout(self):
+        with self.lock:
+            while self.heap and self.heap[0][2] is None:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - time.monotonic())
+
+    # Runs every timer that is due
+    def run_due(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+                timer = heapq.heappop(self.heap)
+                callback = timer[2]
+                if callback is None:
+                    self.cancelled -= 1
+                    continue
+                timer[2] = None
+            callback()
+
+
+class Client:
+    # A connected client. It is in the lobby, or playing or watching a table.
+
+    __slots__ = ('name', 'conn', 'addr', 'idnum', 'game', 'decoder', 'outbox',
+                 'blocked_since', 'connected', 'queued_since')
+
+    def __init__(self, conn, addr, idnum):
+        host, port = addr
+        self.name = '{}:{}'.format(host, port)
+        self.conn = conn
+        self.addr = addr
+        self.idnum = idnum
+        self.game = None            # Table the client is playing or watching
+        self.decoder = tiles.MessageDecoder()
+        self.outbox = bytearray()   # Messages queued until the next flush
+        self.blocked_since = None   # When the socket stopped taking data
+        self.connected = True
+        self.queued_since = None    # When the client last joined the lobby
+
+
+class IdnumAllocator:
+    # Hands out the player id numbers. Ids below the limit are used in turn,
+    # after that the ids of clients that have left are reused, the longest
+    # free first. An id still in use is never handed out again.
+
+    def __init__(self, limit=tiles.IDNUM_LIMIT):
+        self.limit = limit
+        self.next_idnum = 0
+        self.free = collections.deque()
+
+    # Returns a free idnum, or None if every idnum is in use
+    def allocate(self):
+        if self.next_idnum < self.limit:
+            idnum = self.next_idnum
+            self.next_idnum += 1
+            return idnum
+        if self.free:
+            return self.free.popleft()
+        return None
 
-    # Selects players for a new round of game
+    def release(self, idnum):
+        self.free.append(idnum)
+
+
+class Server:
+    COUNT_DOWN = 2          # Count down for a new game
+    MATCH_WAIT = 1          # Seconds a client waits before a smaller table
+    MATCH_MIN = 2           # Fewest players for one while other tables play
+    WAIT_MOVE = 10          # Wait time for server to place a tile instead
+    AUTOPLAY_BUDGET = 0.005 # CPU seconds the server may spend on that move
+    OUTBOX_LIMIT = 262144   # Bytes a client may leave unread before eviction
+    OUTBOX_WAIT = 5         # Seconds a client may leave data unread
+    GAME_LOG = 'games.log'  # Log every game is appended to, None for no log
+    METRICS_FILE = 'metrics.prom'   # Metrics written here, None for none
+    METRICS_INTERVAL = 10   # Seconds between writes of the metrics file
+    PROFILE_SECONDS = 10    # Length of a profile started with SIGUSR1
+    REPORT_INTERVAL = 1     # Seconds between a worker's reports
+
+    def __init__(self, host, port, worker=None, reports=None):
+        self.sock = None
+        self.host = host
+        self.port = port
+        self.worker = worker        # Worker number, None if not a worker
+        self.reports = reports      # Queue of reports to the supervisor
+        self.idnums = IdnumAllocator()
+        self.game_counter = 0
+        self.connections = {}       # idnum -> every connected client
+        self.lobby = {}             # idnum -> clients waiting, longest first
+        self.games = []             # Games currently running
+        self.pending = []           # Clients with queued outbound messages
+        self.blocked = {}           # idnum -> clients whose socket is full
+        self.evictions = 0          # Clients dropped for not reading
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.RLock()   # Guards state shared between threads
+        # Notified whenever a client joins the lobby
+        self.lobby_changed = threading.Condition(self.lock)
+        self.scheduler = Scheduler()    # Turn deadlines of every table
+        self.game_log = None            # Writes games to GAME_LOG
+        self.metrics = metrics.Metrics()
+        self.tracer = tracing.Tracer()  # Spans around the game's hot path
+        self.profiling = False          # True while a profile is taken
+        for owner, attribute in (
+                (Game, 'handle_player'),
+                (Game, 'play_move'),
+                (Game, 'broadcast'),
+                (Server, 'update_spectator'),
+                (Server, 'read_client'),
+                (tiles.Board, 'do_player_movement'),
+                (tiles.Board, 'do_player_movement_at'),
+                (tiles, 'read_message_from_bytearray')):
+            self.tracer.add(owner, attribute)
+        # Lets other threads wake the I/O loop when a client must be watched
+        # for writing, or a timer is due sooner than it is waiting for
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+
+    # Wakes the I/O loop from another thread
+    def wake_up(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass    # The loop has already been woken up
+
+    # Calls callback() on the I/O thread at the given time.monotonic()
+    # deadline, unless the returned timer is cancelled first
+    def set_timer(self, deadline, callback):
+        timer, first = self.scheduler.schedule(deadline, callback)
+        if first:
+            self.wake_up()
+        return timer
+
+    def cancel_timer(self, timer):
+        self.scheduler.cancel(timer)
+
+    # Processes client disconection
+    # It can be reached from a failed send as well as from the I/O thread
+    # seeing EOF, so a client that is already gone is ignored.
+    def disconnect_client(self, client):
+        with self.lock:
+            if not client.connected:
+                return
+            client.connected = False
+            self.close_client(client)
+
+            print('client {} disconnected'.format(client.addr))
+            del self.connections[client.idnum]
+            self.blocked.pop(client.idnum, None)
+            self.lobby.pop(client.idnum, None)
+            # The table the client was playing or watching is told about it
+            game = client.game
+            if game is not None:
+                game.remove_client(client)
+                client.game = None
+                # A player's id is still used by the table until its game is
+                # over, so it is only freed then
+                if client in game.seated:
+                    game.departed.append(client.idnum)
+                    return
+            self.idnums.release(client.idnum)
+
+    # Stops watching a client socket and closes it
+    def close_client(self, client):
+        try:
+            self.selector.unregister(client.conn)
+        except (KeyError, ValueError):
+            pass
+        client.conn.close()
+
+    # Attaches an idle client to a running table as a spectator
+    def watch_game(self, client, game):
+        client.game = game
+        game.audience[client.idnum] = client
+
+    # Called from the game thread once a game is over. Its players and
+    # spectators go back to the lobby to be picked for the next tables.
+    def end_game(self, game):
+        with self.lock:
+            self.games.remove(game)
+            for idnum in game.departed:
+                self.idnums.release(idnum)
+            for client in game.audience.values():
+                client.game = None
+                # Spectators picked from the lobby never left it, and keep
+                # their place and waiting time in the queue
+                if client.idnum not in self.lobby:
+                    self.enqueue(client)
+            # With no table left, a client alone in the lobby may play
+            self.lobby_changed.notify()
+        print(f"Game {game.gameid} is over.")
+
+    # Puts a client at the back of the lobby, to wait for a table.
+    # Called with the lock held.
+    def enqueue(self, client):
+        client.queued_since = time.monotonic()
+        self.lobby[client.idnum] = client
+        self.lobby_changed.notify()
+
+    # Appends a game's latest messages to the game log. The log's own thread
+    # does the writing, so this only queues the records.
+    def log_events(self, game, payload, end=False):
+        if self.game_log is not None:
+            self.game_log.write(game.gameid, game.opened, game.seed, payload,
+                                end)
+
+    # Seconds until the longest waiting client may be given a smaller
+    # table, or None if the lobby is empty. While other tables are playing a
+    # smaller table needs MATCH_MIN players, and clients too few for one
+    # keep watching, so it is None then too. Called with the lock held.
+    def match_timeout(self):
+        if len(self.lobby) < self.MATCH_MIN and self.games:
+            return None
+        for client in self.lobby.values():
+            return max(0, client.queued_since + self.MATCH_WAIT
+                       - time.monotonic())
+        return None
+
+    # Selects players for a new table from the lobby, the clients that have
+    # waited longest first. A full table is made as soon as there are enough
+    # clients, a smaller one once the longest waiting client has waited
+    # MATCH_WAIT seconds, see match_timeout(). Called with the lock held.
+    # Returns the new game, or None if no table can be started yet
     def select_players(self):
-        # Wait few more seconds if there aren't 4 clients connected
-        if len(self.connections) < tiles.PLAYER_LIMIT:
-            # waiting for more connections
-            print(f"Waiting {self.WAIT_PLAYERS} sec for more players")
-            time.sleep(self.WAIT_PLAYERS)
-
-        # If still less than 4 connections, start game anyway with random turn
-        if len(self.connections) < tiles.PLAYER_LIMIT:
-            self.players = random.sample(
-                self.connections, len(self.connections))
-        else:
-            # If 4 or more clients, select 4 at random
-            self.players = random.sample(self.connections, tiles.PLAYER_LIMIT)
+        if len(self.lobby) < tiles.PLAYER_LIMIT:
+            timeout = self.match_timeout()
+            if timeout is None or timeout > 0:
+                return None
 
-        # Each selected player is added to turn queue and live_idnums
-        for player in self.players:
-            self.turn_queue.put(player)
-            self.live_idnums.append(player["idnum"])
-            # Reseting from previous round
-            player["turn"] = 1
-            player["hand"] = []
-            player["start_port"] = None
+        players = list(itertools.islice(
+            self.lobby.values(), tiles.PLAYER_LIMIT))
+
+        now = time.monotonic()
+        for player in players:
+            del self.lobby[player.idnum]
+            self.metrics.queue_wait.observe(now - player.queued_since)
+            # Players stop watching the table they were spectating
+            if player.game is not None:
+                del player.game.audience[player.idnum]
+                player.game = None
+
+        game = Game(self, self.game_counter, players)
+        self.game_counter += 1
+        for player in players:
+            player.game = game
+        # Clients not watching any table watch the new one
+        for client in self.lobby.values():
+            if client.game is None:
+                self.watch_game(client, game)
+        self.games.append(game)
+        return game
 
-    # Start a new round of game
+    # Starts new tables whenever there are clients waiting for a game.
+    # Sleeps until a client joins the lobby or a smaller table is due.
+    # Each table is then played on its own thread.
     def start_game(self):
         while True:
-            if self.connections:
-                # reset everything from previous game
-                self.board.reset()
-                self.players = []
-                self.live_idnums = []
-                self.eliminated = []
-                self.tiles_placed = []
-                self.position_updates = []
-                self.curr_idnum = None
-                self.turn_queue = queue.Queue(tiles.PLAYER_LIMIT)
-
-                self.broadcast(tiles.MessageCountdown().pack())
-                print(f"New game will start in {self.COUNT_DOWN} seconds...")
-                time.sleep(self.COUNT_DOWN)
-
-                # Select players at random
-                self.select_players()
-                self.broadcast(tiles.MessageGameStart().pack())
-                print("Game starts.")
-                self.game_running = True
-
-                # handle the main game loop
-                self.handle_game()
-                break
+            with self.lock:
+                game = self.select_players()
+                while game is None:
+                    if not self.connections:
+                        print("waiting for connections...")
+                    self.lobby_changed.wait(self.match_timeout())
+                    game = self.select_players()
 
-            print("waiting for connections...")
-            time.sleep(self.WAIT_CONNECTIONS)
+            game_thread = threading.Thread(target=game.run, daemon=True)
+            game_thread.start()
 
-    # Sends a message to all connected clients
-    def broadcast(self, message):
-        for client in self.connections:
+    # Queues a message for a client. Messages are not written straight away,
+    # everything queued for a client goes out in a single send when flush()
+    # is called at the end of a turn. msgtype is only given for a message that
+    # does not start with its own type, see metrics.Metrics.message_out().
+    def send(self, client, message, msgtype=None):
+        with self.lock:
+            if not client.connected:
+                return
+            self.metrics.message_out(message, msgtype)
+            outbox = client.outbox
+            if not outbox:
+                self.pending.append(client)
+            outbox += message
+
+    # Writes out the messages queued for every client, one send per client
+    def flush(self):
+        with self.lock:
+            # A failed send disconnects the client, which queues more messages
+            while self.pending:
+                pending = self.pending
+                self.pending = []
+                for client in pending:
+                    # Blocked clients are drained by the I/O loop instead
+                    if client.blocked_since is None:
+                        self.write_client(client)
+
+    # Writes as much of a client's outbox as its socket takes without
+    # blocking. What is left is written by the I/O loop once the socket is
+    # writable again, so one slow reader never holds up a game.
+    def write_client(self, client):
+        with self.lock:
+            if not client.connected:
+                return
+            outbox = client.outbox
             try:
-                client["conn"].send(message)
-            except:
+                sent = client.conn.send(outbox)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
                 # if unsuccessfull, client has been disconnected
                 self.disconnect_client(client)
-                return client
+                return
+            del outbox[:sent]
+
+            if not outbox:
+                if client.blocked_since is not None:
+                    client.blocked_since = None
+                    del self.blocked[client.idnum]
+                    self.selector.modify(
+                        client.conn, selectors.EVENT_READ, client)
+                return
+
+            if client.blocked_since is None:
+                client.blocked_since = time.monotonic()
+                self.blocked[client.idnum] = client
+                self.selector.modify(
+                    client.conn,
+                    selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+                self.wake_up()
+            elif len(outbox) > self.OUTBOX_LIMIT:
+                self.evict_client(client)
+
+    # Drops clients that have left too much data unread for too long
+    def check_blocked(self):
+        with self.lock:
+            now = time.monotonic()
+            for client in list(self.blocked.values()):
+                if (now - client.blocked_since > self.OUTBOX_WAIT
+                        or len(client.outbox) > self.OUTBOX_LIMIT):
+                    self.evict_client(client)
+            self.flush()
+
+    # Disconnects a client that is not reading what it is sent
+    def evict_client(self, client):
+        self.evictions += 1
+        print('client {} is not reading, evicted ({} evictions so far)'.format(
+            client.addr, self.evictions))
+        self.disconnect_client(client)
 
-    # Updates the new connection with the status of the runnning game
+    # Updates the new connection with the status of the runnning games.
+    # The new client watches the table with the fewest spectators and is sent
+    # its cached catch-up, which goes out in the same write as the welcome.
     def update_spectator(self, new_client):
-        conn = new_client["conn"]
-        # Previous connections are introduced to the new client
-        for client in self.connections:
-            conn.send(tiles.MessagePlayerJoined
-                      (client["name"], client["idnum"]).pack())
-        # The new client is updated with player turns, eliminated players,
-        # tile placements and token movements
-        if self.game_running:
-            for idnum in self.live_idnums:
-                conn.send(tiles.MessagePlayerTurn(idnum).pack())
-            for loser in self.eliminated:
-                conn.send(tiles.MessagePlayerEliminated(loser["idnum"]).pack())
-            conn.send(tiles.MessagePlayerTurn(
-                self.curr_player["idnum"]).pack())
-            for tile in self.tiles_placed:
-                conn.send(tile)
-            for update in self.position_updates:
-                conn.send(update)
+        if self.games:
+            game = min(self.games, key=lambda g: len(g.audience))
+            self.send(new_client, game.catch_up(), metrics.CATCH_UP)
+            self.watch_game(new_client, game)
 
     # hande client welcoming and updating them with the status of running game
+    # Runs on the I/O thread, so the game state is locked while it is read.
     def handle_client(self, client):
-        name = client["name"]
-        conn = client["conn"]
-        idnum = client["idnum"]
-
-        conn.send(tiles.MessageWelcome(idnum).pack())
-        # The new client is introduced to previous connections
-        self.broadcast(tiles.MessagePlayerJoined(name, idnum).pack())
-        # Updates the new client with the status of the running game
-        self.update_spectator(client)
-        self.connections.append(client)
-
-    # Accepts all incoming connections
+        idnum = client.idnum
+
+        with self.lock:
+            self.send(client, tiles.MessageWelcome(idnum).pack())
+            # Other clients are introduced to the new client when they end up
+            # at the same table, so nothing is broadcast to everyone here.
+            # Updates the new client with the status of the running game
+            self.update_spectator(client)
+            self.connections[idnum] = client
+            self.enqueue(client)
+            self.flush()
+
+    # Accepts an incoming connection and starts watching it for messages
+    def accept_client(self):
+        # Workers sharing one listening socket all wake up for a connection
+        # that only one of them gets
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+        # Sets a new idnum for the client
+        idnum = self.idnums.allocate()
+        if idnum is None:
+            print('refused connection from {}, all idnums in use'.format(addr))
+            conn.close()
+            return
+        print('received connection from {}'.format(addr))
+
+        new_client = Client(conn, addr, idnum)
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, new_client)
+        self.handle_client(new_client)
+
+    # Reads whatever a client has sent and hands every complete message to
+    # the game the client is in. An empty read means the client has closed.
+    def read_client(self, client):
+        decoder = client.decoder
+        try:
+            received = decoder.recv_into(client.conn)
+        except BlockingIOError:
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self.disconnect_client(client)
+            self.flush()
+            return
+
+        # The decoder's offset moves past each message as it is read
+        offset = decoder.offset
+        for msg in decoder:
+            self.metrics.message_in(msg, decoder.offset - offset)
+            offset = decoder.offset
+            game = client.game
+            if game is not None:
+                game.events.put((client, msg))
+
+    # I/O loop. A single thread multiplexes the listening socket and every
+    # client connection, so no socket goes unread while a game is waiting on
+    # one player, and a closed connection is noticed as soon as it happens.
     def handle_connections(self):
         while True:
-            conn, addr = self.sock.accept()
-            # Sets a new idnum for the client
-            self.idnum_counter = (self.idnum_counter + 1) % tiles.IDNUM_LIMIT
-            print('received connection from {}'.format(addr))
-            host, port = addr
-            name = '{}:{}'.format(host, port)
-
-            # Each client is a dictionary
-            new_client = {
-                "name": name,
-                "conn": conn,
-                "addr": addr,
-                "idnum": self.idnum_counter,
-                "turn": 1,
-                "hand": [],
-                "start_pos": None
-            }
-            handle_client = threading.Thread(
-                target=self.handle_client, args=(new_client, ), daemon=True)
-            handle_client.start()
-
-    # Starts the server socket. Creats a thread that constantly listens
-    # for new connections
-    def start_server(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.bind((self.host, self.port))
-        self.sock.listen()
+            timeout = self.scheduler.timeout()
+            if self.blocked and (timeout is None or timeout > self.OUTBOX_WAIT):
+                timeout = self.OUTBOX_WAIT
+            for key, mask in self.selector.select(timeout):
+                if key.fileobj is self.sock:
+                    self.accept_client()
+                elif key.fileobj is self.wakeup_recv:
+                    self.wakeup_recv.recv(4096)
+                else:
+                    client = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        self.write_client(client)
+                        if not client.connected:
+                            self.flush()
+                    if mask & selectors.EVENT_READ and client.connected:
+                        self.read_client(client)
+            self.scheduler.run_due()
+            if self.blocked:
+                self.check_blocked()
+
+    # Writes the metrics file every METRICS_INTERVAL seconds
+    def write_metrics(self):
+        while True:
+            time.sleep(self.METRICS_INTERVAL)
+            with self.lock:
+                gauges = {
+                    'connections': len(self.connections),
+                    'lobby_clients': len(self.lobby),
+                    'running_games': len(self.games),
+                }
+            self.metrics.write(self.METRICS_FILE, gauges)
+
+    # Profiles the server for PROFILE_SECONDS on a thread of its own, and
+    # writes the results to a profile-<time>.txt file. Started by SIGUSR1.
+    def start_profile(self):
+        if self.profiling:
+            return
+        self.profiling = True
+        path = self.worker_path(
+            'profile-{}.txt'.format(time.strftime('%Y%m%d-%H%M%S')))
+        print('profiling for {} seconds into {}'.format(
+            self.PROFILE_SECONDS, path))
+
+        def run():
+            try:
+                tracing.profile(self.tracer, self.PROFILE_SECONDS, path)
+            finally:
+                self.profiling = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    # Turns the spans on, or off and prints their timings. Started by SIGUSR2.
+    def toggle_tracing(self):
+        # A profile turns the spans off itself once it is done
+        if self.profiling:
+            return
+        if self.tracer.enabled:
+            self.tracer.disable()
+            print(self.tracer.summary())
+        else:
+            self.tracer.reset()
+            self.tracer.enable()
+            print('tracing on')
+
+    # Files written by a worker get its number, so that workers do not
+    # write over each other: games.log is games.2.log for worker 2
+    def worker_path(self, path):
+        if self.worker is None:
+            return path
+        root, dot, ext = path.rpartition('.')
+        return '{}.{}.{}'.format(root, self.worker, ext)
+
+    # Sends the supervisor this worker's counts every REPORT_INTERVAL
+    def report(self):
+        while True:
+            with self.lock:
+                counts = (len(self.connections), len(self.lobby),
+                          len(self.games))
+            self.reports.put((self.worker,) + counts)
+            time.sleep(self.REPORT_INTERVAL)
+
+    # Starts the server socket. Creats a thread that runs the I/O loop for
+    # the listening socket and all client connections. A worker is either
+    # given the supervisor's listening socket, or binds its own to the same
+    # port with SO_REUSEPORT so that the kernel shares connections out.
+    def start_server(self, sock=None):
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if self.worker is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen()
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
         print('listening on {} ...'.format(self.sock.getsockname()))
+        if self.GAME_LOG:
+            self.game_log = gamelog.GameLogWriter(
+                self.worker_path(self.GAME_LOG))
+        if self.METRICS_FILE:
+            self.METRICS_FILE = self.worker_path(self.METRICS_FILE)
+            threading.Thread(target=self.write_metrics, daemon=True).start()
+        if self.reports is not None:
+            threading.Thread(target=self.report, daemon=True).start()
+        # Profiling can be started while the server runs, where there are
+        # signals to start it with
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: self.start_profile())
+            signal.signal(signal.SIGUSR2,
+                          lambda signum, frame: self.toggle_tracing())
 
-        # handle_connections constantly accepts new connections
+        # handle_connections accepts new connections and reads all clients
         handle_conns = threading.Thread(target=self.handle_connections)
         handle_conns.start()
 
-        # Server starts handling the game
+        # Server starts new games as clients become available
         self.start_game()
 
 
+# Runs a server in a worker process
+def run_worker(host, port, worker, reports, sock):
+    server = Server(host, port, worker, reports)
+    server.start_server(sock)
+
+
+class Supervisor:
+    # Runs a number of server processes on the same port, so that games are
+    # spread over as many cores. Each worker owns the games of the clients
+    # it accepts. The workers report their counts to the supervisor, which
+    # prints the totals, and a worker that dies is started again.
+
+    def __init__(self, host, port, workers):
+        self.host = host
+        self.port = port
+        self.workers = [None] * workers     # Process of each worker
+        self.counts = [(0, 0, 0)] * workers # Last report of each worker
+        self.reports = multiprocessing.Queue()
+        self.sock = None
+        # Without SO_REUSEPORT, the workers share the supervisor's socket
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.bind((host, port))
+            self.sock.listen()
+
+    def start_worker(self, worker):
+        process = multiprocessing.Process(
+            target=run_worker, daemon=True,
+            args=(self.host, self.port, worker, self.reports, self.sock))
+        process.start()
+        self.workers[worker] = process
+        self.counts[worker] = (0, 0, 0)
+
+    # Passes a signal on to every worker, so that profiling is started in
+    # all of them at once
+    def forward_signal(self, signum):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def run(self):
+        for worker in range(len(self.workers)):
+            self.start_worker(worker)
+        print('started {} workers on port {}'.format(
+            len(self.workers), self.port))
+        if hasattr(signal, 'SIGUSR1'):
+            for signum in (signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, lambda signum, frame:
+                              self.forward_signal(signum))
+
+        totals = None
+        while True:
+            try:
+                worker, *counts = self.reports.get(
+                    timeout=Server.REPORT_INTERVAL)
+                self.counts[worker] = tuple(counts)
+            except queue.Empty:
+                pass
+
+            for worker, process in enumerate(self.workers):
+                if not process.is_alive():
+                    print('worker {} exited with {}, restarting'.format(
+                        worker, process.exitcode))
+                    self.start_worker(worker)
+
+            new_totals = tuple(map(sum, zip(*self.counts)))
+            if new_totals != totals:
+                totals = new_totals
+                print('{} connections, {} in lobby, {} games running'.format(
+                    *totals))
+
+
 # ------------------ #
 # START OF EXECUTION #
 # -------------------#
-server = Server('', 30020)
-server.start_server()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tiles game server.')
+    parser.add_argument('--port', type=int, default=30020)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes sharing the port')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        Supervisor('', args.port, args.workers).run()
+    else:
+        server = Server('', args.port)
+        server.start_server()
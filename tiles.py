@@ -8,6 +8,8 @@
 # match the below.
 
 import struct
+import sys
+from array import array
 from enum import IntEnum
 from random import randrange
 
@@ -18,6 +20,13 @@ HAND_SIZE = 4    # number of tiles in each player's hand
 PLAYER_LIMIT = 4 # maximum number of players in a single game
 IDNUM_LIMIT = 65536 # player id number limit (used ids should be: 0 <= id < IDNUM_LIMIT)
 
+# precompiled message layouts, so that unpacking does not parse format strings
+TYPE_STRUCT = struct.Struct('!H')
+IDNUM_STRUCT = struct.Struct('!HH')          # type, then a single 16-bit field
+PLAYER_JOINED_STRUCT = struct.Struct('!HHH') # type, idnum, name length
+PLACE_TILE_STRUCT = struct.Struct('!HHHHHH')
+MOVE_TOKEN_STRUCT = struct.Struct('!HHHHH')
+
 
 class MessageType(IntEnum):
   """identify the kinds of messages that can be passed between server and
@@ -36,21 +45,58 @@ class MessageType(IntEnum):
   PLAYER_ELIMINATED = 10
 
 
-class MessageWelcome():
+class Message():
+  """Base of the message classes. A message must not be changed once it is
+  made, so it keeps the bytes it packs to after the first pack(): sending the
+  same message to many clients packs it once.
+
+  Each class lists its fields in __slots__, and packs them with _pack().
+  """
+
+  __slots__ = ('_packed',)
+
+  TYPE = None # the MessageType of the class
+
+  def __init__(self):
+    self._packed = None
+  
+  def pack(self):
+    packed = self._packed
+    if packed is None:
+      packed = self._packed = self._pack()
+    return packed
+  
+  def __eq__(self, other):
+    return type(self) is type(other) and self.pack() == other.pack()
+  
+  def __hash__(self):
+    return hash(self.pack())
+  
+  def __repr__(self):
+    return '{}({})'.format(type(self).__name__, ', '.join(
+      '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class MessageWelcome(Message):
   """Sent by the server to joining clients, to notify them of their idnum."""
 
+  __slots__ = ('idnum',)
+
+  TYPE = MessageType.WELCOME
+
   def __init__(self, idnum: int):
+    self._packed = None
     self.idnum = idnum
   
-  def pack(self):
-    return struct.pack('!HH', MessageType.WELCOME, self.idnum)
+  def _pack(self):
+    return IDNUM_STRUCT.pack(MessageType.WELCOME, self.idnum)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
     
     return None, 0
@@ -58,28 +104,37 @@ class MessageWelcome():
   def __str__(self):
     return f"Welcome to the game! your ID is {self.idnum}."  
 
-class MessagePlayerJoined():
+class MessagePlayerJoined(Message):
   """Sent by the server to all clients, when a new client joins.
   This indicates the name and (unique) idnum for the new client.
   """
 
+  __slots__ = ('name', 'idnum')
+
+  TYPE = MessageType.PLAYER_JOINED
+
   def __init__(self, name: str, idnum: int):
+    self._packed = None
     self.name = name
     self.idnum = idnum
   
-  def pack(self):
-    return struct.pack('!HHH{}s'.format(len(self.name)),
-      MessageType.PLAYER_JOINED, self.idnum,
-      len(self.name), bytes(self.name, 'utf-8'))
+  def _pack(self):
+    # unpacked names are left as bytes
+    name = self.name
+    if isinstance(name, str):
+      name = bytes(name, 'utf-8')
+    return PLAYER_JOINED_STRUCT.pack(MessageType.PLAYER_JOINED, self.idnum,
+      len(name)) + name
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    headerlen = struct.calcsize('!HHH')
-
-    if len(bs) >= headerlen:
-      _, idnum, namelen = struct.unpack_from('!HHH', bs, 0)
-      if len(bs) >= headerlen + namelen:
-        name, = struct.unpack_from('!{}s'.format(namelen), bs, headerlen)
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    headerlen = PLAYER_JOINED_STRUCT.size
+
+    if len(bs) - offset >= headerlen:
+      _, idnum, namelen = PLAYER_JOINED_STRUCT.unpack_from(bs, offset)
+      if len(bs) - offset >= headerlen + namelen:
+        start = offset + headerlen
+        name = bytes(bs[start:start + namelen])
         return MessagePlayerJoined(name, idnum), headerlen + namelen
     
     return None, 0
@@ -87,21 +142,26 @@ class MessagePlayerJoined():
   def __str__(self):
     return f"Player {self.name} has joined the game!"  
 
-class MessagePlayerLeft():
+class MessagePlayerLeft(Message):
   """Sent by the server to all remaining clients, when a client leaves."""
 
+  __slots__ = ('idnum',)
+
+  TYPE = MessageType.PLAYER_LEFT
+
   def __init__(self, idnum: int):
+    self._packed = None
     self.idnum = idnum
   
-  def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_LEFT, self.idnum)
+  def _pack(self):
+    return IDNUM_STRUCT.pack(MessageType.PLAYER_LEFT, self.idnum)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
     
     return None, 0
@@ -109,39 +169,70 @@ class MessagePlayerLeft():
   def __str__(self):
     return f"A player has left the game."  
 
-class MessageCountdown():
+class MessageCountdown(Message):
   """Sent by the server to all clients, when the countdown for a new game has
-  started.
+  started. The message never changes, use COUNTDOWN_MESSAGE.
   """
 
-  def pack(self):
-    return struct.pack('!H', MessageType.COUNTDOWN_STARTED)
+  __slots__ = ()
 
+  TYPE = MessageType.COUNTDOWN_STARTED
 
-class MessageGameStart():
-  """Sent by the server to all clients, when a new game has started."""
+  def _pack(self):
+    return TYPE_STRUCT.pack(MessageType.COUNTDOWN_STARTED)
+  
+  @classmethod
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    if len(bs) - offset >= TYPE_STRUCT.size:
+      return COUNTDOWN_MESSAGE, TYPE_STRUCT.size
+    
+    return None, 0
 
-  def pack(self):
-    return struct.pack('!H', MessageType.GAME_START)
 
+class MessageGameStart(Message):
+  """Sent by the server to all clients, when a new game has started. The
+  message never changes, use GAME_START_MESSAGE.
+  """
+
+  __slots__ = ()
 
-class MessageAddTileToHand():
+  TYPE = MessageType.GAME_START
+
+  def _pack(self):
+    return TYPE_STRUCT.pack(MessageType.GAME_START)
+  
+  @classmethod
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    if len(bs) - offset >= TYPE_STRUCT.size:
+      return GAME_START_MESSAGE, TYPE_STRUCT.size
+    
+    return None, 0
+
+
+class MessageAddTileToHand(Message):
   """Sent by the server to a single client, to add a new tile to that client's
-  hand.
+  hand. There is one message for each tile in ADD_TILE_TO_HAND_MESSAGES.
   """
 
+  __slots__ = ('tileid',)
+
+  TYPE = MessageType.ADD_TILE_TO_HAND
+
   def __init__(self, tileid):
+    self._packed = None
     self.tileid = tileid
   
-  def pack(self):
-    return struct.pack('!HH', MessageType.ADD_TILE_TO_HAND, self.tileid)
+  def _pack(self):
+    return IDNUM_STRUCT.pack(MessageType.ADD_TILE_TO_HAND, self.tileid)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, tileid = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, tileid = IDNUM_STRUCT.unpack_from(bs, offset)
+      if tileid < len(ADD_TILE_TO_HAND_MESSAGES):
+        return ADD_TILE_TO_HAND_MESSAGES[tileid], messagelen
       return MessageAddTileToHand(tileid), messagelen
     
     return None, 0
@@ -149,23 +240,28 @@ class MessageAddTileToHand():
   def __str__(self):
     return "Tiles are now added to your hand!"
 
-class MessagePlayerTurn():
+class MessagePlayerTurn(Message):
   """Sent by the server to all clients to indicate that a new turn has
   started.
   """
 
+  __slots__ = ('idnum',)
+
+  TYPE = MessageType.PLAYER_TURN
+
   def __init__(self, idnum: int):
+    self._packed = None
     self.idnum = idnum
   
-  def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_TURN, self.idnum)
+  def _pack(self):
+    return IDNUM_STRUCT.pack(MessageType.PLAYER_TURN, self.idnum)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
     
     return None, 0
@@ -173,7 +269,7 @@ class MessagePlayerTurn():
   def __str__(self):
     return "A new turn has started!"  
 
-class MessagePlaceTile():
+class MessagePlaceTile(Message):
   """Sent by the current player to the server to indicate that they want to
   place a tile from their hand in a particular location on the board.
 
@@ -181,23 +277,28 @@ class MessagePlaceTile():
   the board.
   """
 
+  __slots__ = ('idnum', 'tileid', 'rotation', 'x', 'y')
+
+  TYPE = MessageType.PLACE_TILE
+
   def __init__(self, idnum: int, tileid: int, rotation: int, x: int, y: int):
+    self._packed = None
     self.idnum = idnum
     self.tileid = tileid
     self.rotation = rotation
     self.x = x
     self.y = y
   
-  def pack(self):
-    return struct.pack('!HHHHHH', MessageType.PLACE_TILE, self.idnum,
+  def _pack(self):
+    return PLACE_TILE_STRUCT.pack(MessageType.PLACE_TILE, self.idnum,
       self.tileid, self.rotation, self.x, self.y)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HHHHHH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = PLACE_TILE_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum, tileid, rotation, x, y = struct.unpack_from('!HHHHHH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum, tileid, rotation, x, y = PLACE_TILE_STRUCT.unpack_from(bs, offset)
       return MessagePlaceTile(idnum, tileid, rotation, x, y), messagelen
     
     return None, 0
@@ -205,7 +306,7 @@ class MessagePlaceTile():
   def __str__(self):
     return "A player placed his/her tile!"  
 
-class MessageMoveToken():
+class MessageMoveToken(Message):
   """Sent by the current player to the server on turn 2, to indicate which
   starting location they choose for their token.
 
@@ -214,22 +315,27 @@ class MessageMoveToken():
   tile causes their token to move).
   """
 
+  __slots__ = ('idnum', 'x', 'y', 'position')
+
+  TYPE = MessageType.MOVE_TOKEN
+
   def __init__(self, idnum: int, x: int, y: int, position: int):
+    self._packed = None
     self.idnum = idnum
     self.x = x
     self.y = y
     self.position = position
   
-  def pack(self):
-    return struct.pack('!HHHHH', MessageType.MOVE_TOKEN, self.idnum,
+  def _pack(self):
+    return MOVE_TOKEN_STRUCT.pack(MessageType.MOVE_TOKEN, self.idnum,
       self.x, self.y, self.position)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HHHHH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = MOVE_TOKEN_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum, x, y, position = struct.unpack_from('!HHHHH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum, x, y, position = MOVE_TOKEN_STRUCT.unpack_from(bs, offset)
       return cls(idnum, x, y, position), messagelen
     
     return None, 0
@@ -237,24 +343,29 @@ class MessageMoveToken():
   def __str__(self):
     return "Player has decided its starting position!"  
 
-class MessagePlayerEliminated():
+class MessagePlayerEliminated(Message):
   """Sent by the server to all clients when a player is eliminated from the
   current game (either because their token left the board, or because the
   client disconnected).
   """
 
+  __slots__ = ('idnum',)
+
+  TYPE = MessageType.PLAYER_ELIMINATED
+
   def __init__(self, idnum: int):
+    self._packed = None
     self.idnum = idnum
   
-  def pack(self):
-    return struct.pack('!HH', MessageType.PLAYER_ELIMINATED, self.idnum)
+  def _pack(self):
+    return IDNUM_STRUCT.pack(MessageType.PLAYER_ELIMINATED, self.idnum)
   
   @classmethod
-  def unpack(cls, bs: bytearray):
-    messagelen = struct.calcsize('!HH')
+  def unpack(cls, bs: bytearray, offset: int = 0):
+    messagelen = IDNUM_STRUCT.size
 
-    if len(bs) >= messagelen:
-      _, idnum = struct.unpack_from('!HH', bs, 0)
+    if len(bs) - offset >= messagelen:
+      _, idnum = IDNUM_STRUCT.unpack_from(bs, offset)
       return cls(idnum), messagelen
     
     return None, 0
@@ -263,57 +374,232 @@ class MessagePlayerEliminated():
     return "A player has been eliminated!"  
 
 
-def read_message_from_bytearray(bs: bytearray):
-  """Attempts to read and unpack a single message from the beginning of the
-  provided bytearray. If successful, it returns (msg, number_of_bytes_consumed).
-  If unable to read a message (because there are insufficient bytes), it returns
-  (None, 0).
+# messages that never change, packed once
+COUNTDOWN_MESSAGE = MessageCountdown()
+COUNTDOWN_MESSAGE.pack()
+GAME_START_MESSAGE = MessageGameStart()
+GAME_START_MESSAGE.pack()
+
+
+class MessageCodec:
+  """How one type of message is read. struct is the fixed part of the message,
+  type included, and fields names the values it holds after the type, in
+  order. A message that ends with a variable-length tail (a player's name) has
+  length, a function giving the length of the whole message at an offset in a
+  buffer from its fixed part (0 if that has not all arrived), and tail, the
+  name of the tail.
   """
 
-  msg = None
-  consumed = 0
+  __slots__ = ('cls', 'unpack', 'struct', 'fields', 'size', 'length', 'tail')
+
+  def __init__(self, cls, struct, fields, length=None, tail=None):
+    self.cls = cls
+    self.unpack = cls.unpack
+    self.struct = struct
+    self.fields = fields
+    self.size = struct.size if length == None else None
+    self.length = length
+    self.tail = tail
+
+
+def player_joined_length(bs, offset: int = 0):
+  if len(bs) - offset < PLAYER_JOINED_STRUCT.size:
+    return 0
+  _, _, namelen = PLAYER_JOINED_STRUCT.unpack_from(bs, offset)
+  return PLAYER_JOINED_STRUCT.size + namelen
+
+
+# message type -> MessageCodec, for every type of message
+MESSAGE_CODECS = {codec.cls.TYPE: codec for codec in [
+  MessageCodec(MessageWelcome, IDNUM_STRUCT, ('idnum',)),
+  MessageCodec(MessagePlayerJoined, PLAYER_JOINED_STRUCT,
+    ('idnum', 'namelen'), player_joined_length, 'name'),
+  MessageCodec(MessagePlayerLeft, IDNUM_STRUCT, ('idnum',)),
+  MessageCodec(MessageCountdown, TYPE_STRUCT, ()),
+  MessageCodec(MessageGameStart, TYPE_STRUCT, ()),
+  MessageCodec(MessageAddTileToHand, IDNUM_STRUCT, ('tileid',)),
+  MessageCodec(MessagePlayerTurn, IDNUM_STRUCT, ('idnum',)),
+  MessageCodec(MessagePlaceTile, PLACE_TILE_STRUCT,
+    ('idnum', 'tileid', 'rotation', 'x', 'y')),
+  MessageCodec(MessageMoveToken, MOVE_TOKEN_STRUCT,
+    ('idnum', 'x', 'y', 'position')),
+  MessageCodec(MessagePlayerEliminated, IDNUM_STRUCT, ('idnum',)),
+]}
+
+
+def read_message_from_bytearray(bs: bytearray, offset: int = 0):
+  """Attempts to read and unpack a single message from the provided bytearray,
+  starting at offset (the beginning by default). If successful, it returns
+  (msg, number_of_bytes_consumed). If unable to read a message (because there
+  are insufficient bytes), it returns (None, 0).
+  """
 
-  typesize = struct.calcsize('!H')
+  if len(bs) - offset >= TYPE_STRUCT.size:
+    typeint, = TYPE_STRUCT.unpack_from(bs, offset)
+    codec = MESSAGE_CODECS.get(typeint)
+    if codec != None:
+      return codec.unpack(bs, offset)
+  
+  return None, 0
 
-  if len(bs) >= typesize:
-    typeint, = struct.unpack_from('!H', bs, 0)
 
-    if typeint == MessageType.WELCOME:
-      msg, consumed = MessageWelcome.unpack(bs)
-    
-    elif typeint == MessageType.PLAYER_JOINED:
-      msg, consumed = MessagePlayerJoined.unpack(bs)
-    
-    elif typeint == MessageType.PLAYER_LEFT:
-      msg, consumed = MessagePlayerLeft.unpack(bs)
+def decode_columns(bs, offset: int = 0):
+  """Decode every complete message in bs from offset, without making a message
+  object for each. Returns (columns, number_of_bytes_consumed), where columns
+  maps each MessageType found to a dict of its fields, each an array of the
+  values of that field in every message of the type, in order. The 'offset'
+  array holds where each message starts, to put messages of different types
+  back in order; a tail is a list of bytes.
 
-    elif typeint == MessageType.COUNTDOWN_STARTED:
-      msg, consumed = MessageCountdown(), typesize
-    
-    elif typeint == MessageType.GAME_START:
-      msg, consumed = MessageGameStart(), typesize
-    
-    elif typeint == MessageType.ADD_TILE_TO_HAND:
-      msg, consumed = MessageAddTileToHand.unpack(bs)
-    
-    elif typeint == MessageType.PLAYER_TURN:
-      msg, consumed = MessagePlayerTurn.unpack(bs)
-    
-    elif typeint == MessageType.PLACE_TILE:
-      msg, consumed = MessagePlaceTile.unpack(bs)
-    
-    elif typeint == MessageType.MOVE_TOKEN:
-      msg, consumed = MessageMoveToken.unpack(bs)
+  The arrays can be used by NumPy without copying, with numpy.asarray().
+  Decoding stops at the first unknown type of message, as
+  read_message_from_bytearray() does.
+  """
+  start = offset
+  end = len(bs)
+  codecs = MESSAGE_CODECS
+  fieldbytes = {} # type -> the bytes of each message's fields, back to back
+  offsets = {}    # type -> offset of each message
+  tails = {}      # type -> tail of each message
+  readers = {}    # type -> what is needed to read it in the loop below
+
+  with memoryview(bs) as view, view.cast('B') as view:
+    while end - offset >= 2:
+      typeint = view[offset] << 8 | view[offset + 1]
+      reader = readers.get(typeint)
+
+      if reader == None:
+        codec = codecs.get(typeint)
+        if codec == None:
+          break
+        fieldbytes[typeint] = bytearray()
+        offsets[typeint] = array('Q')
+        tails[typeint] = [] if codec.tail else None
+        reader = readers[typeint] = (codec.size, codec.length,
+          codec.struct.size, fieldbytes[typeint], offsets[typeint].append,
+          tails[typeint])
+      
+      size, length, fixedsize, data, addoffset, tail = reader
+      if not size:
+        size = length(view, offset)
+        if not size:
+          break
+      if end - offset < size:
+        break
+      
+      data += view[offset + 2:offset + fixedsize]
+      addoffset(offset)
+      if tail != None:
+        tail.append(bytes(view[offset + fixedsize:offset + size]))
+      
+      offset += size
+  
+  columns = {}
+  for typeint, data in fieldbytes.items():
+    codec = codecs[typeint]
+    # every field is an unsigned 16-bit value, in network byte order
+    values = array('H', data)
+    if sys.byteorder == 'little':
+      values.byteswap()
     
-    elif typeint == MessageType.PLAYER_ELIMINATED:
-      msg, consumed = MessagePlayerEliminated.unpack(bs)
-  #print("MESSAGE@@@@@@@@@", msg, type(msg))
-  return msg, consumed
+    fields = codec.fields
+    column = {'offset': offsets[typeint]}
+    for i, name in enumerate(fields):
+      column[name] = values[i::len(fields)]
+    if codec.tail:
+      column[codec.tail] = tails[typeint]
+    if len(offsets[typeint]):
+      columns[MessageType(typeint)] = column
+  
+  return columns, offset - start
+
+
+class MessageDecoder:
+  """Decodes a stream of messages as it arrives, without copying the rest of
+  the buffer after every message.
+
+  Received bytes are appended to a single bytearray and messages are unpacked
+  in place from a read offset. Consumed bytes are only dropped from the front of
+  the buffer once everything has been read, or once enough has piled up. The
+  bytearray keeps its spare room past the received bytes, so recv_into() can
+  usually receive straight into it without growing it.
 
+  Either feed() it the bytes from a recv(), or let it recv_into() its own
+  buffer, then iterate over it to get every complete message received so far:
 
-def get_random_tileid():
-  """Get a random, valid tileid."""
-  return randrange(0, len(ALL_TILES))
+    decoder = MessageDecoder()
+    while decoder.recv_into(sock):
+      for msg in decoder:
+        ...
+  """
+
+  COMPACT_SIZE = 65536 # drop consumed bytes once this many have piled up
+
+  def __init__(self):
+    self.buffer = bytearray()
+    self.offset = 0 # position of the first byte that has not been decoded
+    self.end = 0 # end of the received bytes, the rest of the buffer is spare
+  
+  def feed(self, data):
+    """Add received bytes to the end of the stream."""
+    # overwrites the spare room, and grows the buffer for what does not fit
+    self.buffer[self.end:self.end + len(data)] = data
+    self.end += len(data)
+  
+  def recv_into(self, sock, nbytes: int = 4096):
+    """Receive up to nbytes from sock straight into the end of the buffer.
+    Returns the number of bytes received, which is 0 once the peer has closed
+    the connection.
+    """
+    buffer = self.buffer
+    end = self.end
+    # the buffer is only grown when its spare room is too small
+    if len(buffer) - end < nbytes:
+      buffer += bytes(nbytes)
+
+    with memoryview(buffer) as view, view[end:end + nbytes] as tail:
+      received = sock.recv_into(tail, nbytes)
+
+    self.end = end + received
+    return received
+  
+  def pending(self):
+    """Number of received bytes that do not form a complete message yet."""
+    return self.end - self.offset
+  
+  def __iter__(self):
+    # only the received bytes are decoded, never the spare room after them
+    with memoryview(self.buffer) as view, view[:self.end] as received:
+      while True:
+        msg, consumed = read_message_from_bytearray(received, self.offset)
+        if not consumed:
+          break
+        
+        self.offset += consumed
+        yield msg
+    
+    self.compact()
+  
+  def compact(self):
+    """Drop bytes that have already been decoded from the buffer."""
+    if self.offset == self.end:
+      # the room is kept for the next recv, unless a burst has made it large
+      if len(self.buffer) > self.COMPACT_SIZE:
+        self.buffer.clear()
+      self.offset = 0
+      self.end = 0
+    elif self.offset >= self.COMPACT_SIZE:
+      del self.buffer[:self.offset]
+      self.end -= self.offset
+      self.offset = 0
+
+
+def get_random_tileid(rng=None):
+  """Get a random, valid tileid. If rng (a random.Random) is given, it is used
+  instead of the module's shared generator."""
+  if rng == None:
+    return randrange(0, len(ALL_TILES))
+  return rng.randrange(0, len(ALL_TILES))
 
 
 class Board:
@@ -328,7 +614,15 @@ class Board:
     self.tilerotations = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
     self.tileplaceids = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
     self.tilerects = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
+    self.tilelines = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
+    self.drawntiles = [None] * (BOARD_WIDTH * BOARD_HEIGHT)
+    self.tokenitems = {}
+    self.drawntokens = {}
     self.playerpositions = {}
+    self.playerorder = {}
+    self.squaretokens = [[] for _ in range(BOARD_WIDTH * BOARD_HEIGHT)]
+    self.squareneighbours = square_neighbours(self.width, self.height)
+    self.squareedgeports = square_edge_ports(self.width, self.height)
     self.tile_size_px = 100
 
   def reset(self):
@@ -337,8 +631,26 @@ class Board:
       self.tileids[i] = None
       self.tilerotations[i] = None
       self.tileplaceids[i] = None
+      self.squaretokens[i].clear()
     
     self.playerpositions = {}
+    self.playerorder = {}
+
+  def copy(self):
+    """Get a copy of the board, that moves can be tried on without changing
+    this board."""
+    board = Board()
+    board.width = self.width
+    board.height = self.height
+    board.tileids = list(self.tileids)
+    board.tilerotations = list(self.tilerotations)
+    board.tileplaceids = list(self.tileplaceids)
+    board.playerpositions = dict(self.playerpositions)
+    board.playerorder = dict(self.playerorder)
+    board.squaretokens = [list(tokens) for tokens in self.squaretokens]
+    board.squareneighbours = self.squareneighbours
+    board.squareedgeports = self.squareedgeports
+    return board
 
   def get_tile(self, x: int, y: int):
     """Get (tile id, rotation, placer id) for location x, y."""
@@ -417,13 +729,7 @@ class Board:
       return False
 
     # is position in tile valid?
-    if (position == 0 or position == 1) and y != BOARD_HEIGHT - 1:
-      return False
-    if (position == 2 or position == 3) and x != BOARD_WIDTH - 1:
-      return False
-    if (position == 4 or position == 5) and y != 0:
-      return False
-    if (position == 6 or position == 7) and x != 0:
+    if not position in self.squareedgeports[idx]:
       return False
 
     self.update_player_position(idnum, x, y, position)
@@ -459,37 +765,84 @@ class Board:
         continue
 
       x, y, position = playerposition
-      idx = self.tile_index(x, y)
-      moved = False
-
-      while self.tileids[idx] != None:
-        moved = True
-        tileid = self.tileids[idx]
-        rotation = self.tilerotations[idx]
-        tile = ALL_TILES[tileid]
-        exitposition = tile.getmovement(rotation, position)
-
-        # determine next square to move into from this exit position
-        dx, dy, dposition = CONNECTION_NEIGHBOURS[exitposition]
-        nx = x + dx
-        ny = y + dy
-
-        # if that square would be off the board, we're eliminated
-        if nx < 0 or nx >= BOARD_WIDTH or ny < 0 or ny >= BOARD_HEIGHT:
-          position = exitposition
-          eliminated.append(idnum)
-          break
-        
-        # otherwise move into that square and continue the loop (if a tile is in the square)
-        x, y, position = nx, ny, dposition
-        idx = self.tile_index(x, y)
-      
-      if moved:
-        self.update_player_position(idnum, x, y, position)
-        positionupdates.append(MessageMoveToken(idnum, x, y, position))
+      self.move_token(idnum, self.tile_index(x, y), position, positionupdates,
+        eliminated)
     
     return positionupdates, eliminated
 
+  def do_player_movement_at(self, x: int, y: int, live_idnums):
+    """Move the player tokens that can be moved by a tile that was just placed
+    at x, y (or by a token that was just started on it).
+
+    Between placements, every live token is either on an empty square or has
+    been eliminated, so the tokens on the changed square are the only ones that
+    can move. This gives the same result as do_player_movement, as long as
+    eliminated players are removed from live_idnums, but only looks at the
+    tokens on that square.
+
+    Returns positionupdates, eliminated in the same form as do_player_movement.
+    """
+    positionupdates = []
+    eliminated = []
+
+    idx = self.tile_index(x, y)
+    tokens = self.squaretokens[idx]
+
+    if len(tokens) > 1:
+      # keep the order in which do_player_movement would visit the tokens
+      tokens = sorted(tokens, key=self.playerorder.__getitem__)
+    else:
+      tokens = list(tokens)
+
+    for idnum in tokens:
+      if not idnum in live_idnums:
+        continue
+
+      _, _, position = self.playerpositions[idnum]
+      self.move_token(idnum, idx, position, positionupdates, eliminated)
+
+    return positionupdates, eliminated
+
+  def legal_tile_squares(self, idnum):
+    """Get the squares where the given player may place a tile, as a list of
+    x, y tuples.
+
+    If the player's token is on the board, this is the square the token is
+    entering. Otherwise it is every empty square on the edge of the board.
+    """
+    if self.have_player_position(idnum):
+      x, y, _ = self.playerpositions[idnum]
+      if self.tileids[self.tile_index(x, y)] != None:
+        return []
+      return [(x, y)]
+
+    squares = []
+    for idx, ports in enumerate(self.squareedgeports):
+      if ports and self.tileids[idx] == None:
+        y, x = divmod(idx, self.width)
+        squares.append((x, y))
+    return squares
+
+  def legal_start_positions(self, idnum):
+    """Get the starting positions the given player may choose for their
+    token, as a list of x, y, position tuples.
+
+    These are the positions touching the edge of the board on the tiles that
+    the player has placed. The list is empty if the player's token is already
+    on the board.
+    """
+    if self.have_player_position(idnum):
+      return []
+
+    positions = []
+    for idx, placeid in enumerate(self.tileplaceids):
+      if placeid != idnum or self.tileids[idx] == None:
+        continue
+      y, x = divmod(idx, self.width)
+      for position in self.squareedgeports[idx]:
+        positions.append((x, y, position))
+    return positions
+
   # 
   # METHODS BELOW HERE ARE PRIVATE OR ONLY NEEDED BY THE CLIENT
   # -----------------------------------------------------------
@@ -498,7 +851,50 @@ class Board:
     return x + y*self.width
 
   def update_player_position(self, idnum, x: int, y: int, position: int):
+    if idnum in self.playerpositions:
+      oldx, oldy, _ = self.playerpositions[idnum]
+      self.squaretokens[self.tile_index(oldx, oldy)].remove(idnum)
+    else:
+      self.playerorder[idnum] = len(self.playerorder)
+
+    self.squaretokens[self.tile_index(x, y)].append(idnum)
     self.playerpositions[idnum] = (x, y, position)
+
+  def move_token(self, idnum, idx: int, position: int, positionupdates, eliminated):
+    """Move a single token from square idx, if there is a tile to move it, and
+    record the result in positionupdates and eliminated.
+    """
+    tileids = self.tileids
+    tileid = tileids[idx]
+
+    if tileid == None:
+      return
+
+    tilerotations = self.tilerotations
+    neighbours = self.squareneighbours
+
+    while True:
+      exitposition, _, _, dposition = TILE_TRANSITIONS[
+        (tileid*4 + tilerotations[idx])*8 + position]
+
+      # determine next square to move into from this exit position
+      nidx = neighbours[idx*8 + exitposition]
+
+      # if that square would be off the board, we're eliminated
+      if nidx < 0:
+        position = exitposition
+        eliminated.append(idnum)
+        break
+
+      # otherwise move into that square and continue the loop (if a tile is in the square)
+      idx, position = nidx, dposition
+      tileid = tileids[idx]
+      if tileid == None:
+        break
+
+    y, x = divmod(idx, self.width)
+    self.update_player_position(idnum, x, y, position)
+    positionupdates.append(MessageMoveToken(idnum, x, y, position))
   
   def draw_squares(self, canvas, offset, onclick):
     for x in range(self.width):
@@ -516,51 +912,99 @@ class Board:
           canvas.tag_bind(tid, "<Button-1>", lambda ev, x=x, y=y: onclick(x, y))
   
   def draw_tiles(self, canvas, offset):
-    canvas.delete('board_tile')
+    """Bring the drawn tiles up to date with the board. Only squares that
+    changed since the last call are touched, and the lines of a square are
+    moved into place rather than drawn again."""
+    created = False
 
-    for x in range(self.width):
-      xpix = offset.x + x*self.tile_size_px
-      for y in range(self.height):
-        ypix = offset.y + y*self.tile_size_px
+    for idx in range(len(self.tileids)):
+      tileid = self.tileids[idx]
+      drawn = None if tileid == None else (tileid, self.tilerotations[idx])
 
-        idx = self.tile_index(x, y)
-        tileid = self.tileids[idx]
+      if drawn == self.drawntiles[idx]:
+        continue
+      self.drawntiles[idx] = drawn
 
-        if tileid != None:
-          tile = ALL_TILES[tileid]
-          rotation = self.tilerotations[idx]
-          
-          tile.draw(canvas, self.tile_size_px, Point(xpix, ypix), rotation,
-            tags=('board_tile', 'board_tile_{}_{}'.format(x, y)))
-          
-          trect = self.tilerects[idx]
-          if trect:
-            canvas.itemconfigure(trect, fill="#bbb", activefill="#bbb")
+      lines = self.tilelines[idx]
+
+      if drawn == None:
+        if lines:
+          for line in lines:
+            canvas.itemconfigure(line, state='hidden')
+        continue
+
+      y, x = divmod(idx, self.width)
+      xpix = offset.x + x*self.tile_size_px
+      ypix = offset.y + y*self.tile_size_px
+      tile = ALL_TILES[tileid]
+      rotation = self.tilerotations[idx]
+
+      if lines:
+        coords = tile.line_coords(rotation, self.tile_size_px)
+        for line, (ax, ay, bx, by) in zip(lines, coords):
+          canvas.coords(line, xpix + ax, ypix + ay, xpix + bx, ypix + by)
+          canvas.itemconfigure(line, state='normal')
+      else:
+        self.tilelines[idx] = tile.draw(canvas, self.tile_size_px,
+          Point(xpix, ypix), rotation,
+          tags=('board_tile', 'board_tile_{}_{}'.format(x, y)))
+        created = True
+      
+      trect = self.tilerects[idx]
+      if trect:
+        canvas.itemconfigure(trect, fill="#bbb", activefill="#bbb")
     
-    canvas.lift('selection_token')
+    # new lines are drawn on top, so put the tokens back above them
+    if created:
+      canvas.lift('token')
+      canvas.lift('selection_token')
   
   def draw_tokens(self, canvas, offset, playernums, eliminated):
-    canvas.delete('token')
+    """Bring the drawn tokens up to date with the board, moving the tokens
+    that changed."""
+    for idnum in list(self.tokenitems):
+      if idnum not in self.playerpositions:
+        canvas.delete(self.tokenitems.pop(idnum))
+        del self.drawntokens[idnum]
 
     for idnum, playerposition in self.playerpositions.items():
       x, y, position = playerposition
 
-      xpix = offset.x + x*self.tile_size_px
-      ypix = offset.y + y*self.tile_size_px
-
       playernum = playernums[idnum]
       playercol = PLAYER_COLOURS[playernum]
 
       if idnum in eliminated:
         playercol = '#ddd'
 
+      drawn = (x, y, position, playercol)
+      if self.drawntokens.get(idnum) == drawn:
+        continue
+      self.drawntokens[idnum] = drawn
+
+      xpix = offset.x + x*self.tile_size_px
+      ypix = offset.y + y*self.tile_size_px
+
       delta = CONNECTION_LOCATIONS[position]
 
       cx = xpix + int(delta.x * self.tile_size_px)
       cy = ypix + int(delta.y * self.tile_size_px)
 
-      canvas.create_oval(cx - 10, cy - 10, cx + 10, cy + 10,
-        fill=playercol, outline='black', tags=('token'))
+      token = self.tokenitems.get(idnum)
+      if token:
+        canvas.coords(token, cx - 10, cy - 10, cx + 10, cy + 10)
+        canvas.itemconfigure(token, fill=playercol)
+      else:
+        self.tokenitems[idnum] = canvas.create_oval(cx - 10, cy - 10,
+          cx + 10, cy + 10, fill=playercol, outline='black', tags=('token'))
+  
+  def clear_drawing(self, canvas):
+    """Hide the drawn tiles, to be reused by later draws, and remove the
+    drawn tokens."""
+    canvas.itemconfigure('board_tile', state='hidden')
+    canvas.delete('token')
+    self.drawntiles = [None] * len(self.tileids)
+    self.tokenitems = {}
+    self.drawntokens = {}
 
   def draw_selection_token(self, canvas, playernum, xpix: int, ypix: int, connector: int, callback):
     delta = CONNECTION_LOCATIONS[connector]
@@ -632,6 +1076,7 @@ class Tile:
       self.nextpoint[b] = a
     
     self.connections = connections
+    self.linecache = {} # (rotation, size_px) -> line coordinates
   
   def getmovement(self, rotation, fromposition):
     unrotated = ((fromposition-2*rotation)+8)%8
@@ -639,21 +1084,31 @@ class Tile:
     nextposition = (nextposition+2*rotation)%8
     return nextposition
   
+  def line_coords(self, rotation, size_px):
+    """Get the (ax, ay, bx, by) of each connection line, relative to the
+    tile's corner. Computed once for each rotation and size."""
+    key = (rotation, size_px)
+    coords = self.linecache.get(key)
+    if coords == None:
+      lines = []
+      for a, b in self.connections:
+        apos = CONNECTION_LOCATIONS[(a+2*rotation)%8]
+        bpos = CONNECTION_LOCATIONS[(b+2*rotation)%8]
+        lines.append((int(apos.x * size_px), int(apos.y * size_px),
+          int(bpos.x * size_px), int(bpos.y * size_px)))
+      coords = self.linecache[key] = tuple(lines)
+    return coords
+  
   def draw(self, canvas, size_px, basepoint, rotation, tags):
-    for i in range(4):
-      a, b = self.connections[i]
-
-      apos = CONNECTION_LOCATIONS[(a+2*rotation)%8]
-      bpos = CONNECTION_LOCATIONS[(b+2*rotation)%8]
-
-      ax = basepoint.x + int(apos.x * size_px)
-      ay = basepoint.y + int(apos.y * size_px)
+    """Draw the tile's lines, returning their canvas item ids."""
+    lines = []
 
-      bx = basepoint.x + int(bpos.x * size_px)
-      by = basepoint.y + int(bpos.y * size_px)
-
-      canvas.create_line(ax, ay, bx, by, width=3,
-        fill="#000000", activefill="#66ccee", tags=tags)
+    for ax, ay, bx, by in self.line_coords(rotation, size_px):
+      lines.append(canvas.create_line(basepoint.x + ax, basepoint.y + ay,
+        basepoint.x + bx, basepoint.y + by, width=3,
+        fill="#000000", activefill="#66ccee", tags=tags))
+    
+    return lines
 
 
 ALL_TILES = [Tile(x) for x in [
@@ -672,6 +1127,12 @@ ALL_TILES = [Tile(x) for x in [
   [(0, 2), (1, 5), (3, 6), (4, 7)]
 ]]
 
+# the message adding each tile to a hand, packed once
+ADD_TILE_TO_HAND_MESSAGES = tuple(
+  MessageAddTileToHand(tileid) for tileid in range(len(ALL_TILES)))
+for _msg in ADD_TILE_TO_HAND_MESSAGES:
+  _msg.pack()
+
 PLAYER_COLOURS = [
   '#4477AA', # blue
   '#EE6677', # red
@@ -709,3 +1170,64 @@ CONNECTION_NEIGHBOURS = [
   (-1,  0,  3),
   (-1,  0,  2)
 ]
+
+# Movement across a single tile, precomputed for every tile, rotation and entry
+# position so that token movement does not redo the rotation arithmetic. Index
+# with (tileid*4 + rotation)*8 + position, each entry is
+# (exitposition, dx, dy, position in the next square).
+TILE_TRANSITIONS = []
+
+for tile in ALL_TILES:
+  for rotation in range(4):
+    for position in range(8):
+      exitposition = tile.getmovement(rotation, position)
+      dx, dy, dposition = CONNECTION_NEIGHBOURS[exitposition]
+      TILE_TRANSITIONS.append((exitposition, dx, dy, dposition))
+
+TILE_TRANSITIONS = tuple(TILE_TRANSITIONS)
+
+_square_neighbours_cache = {}
+
+def square_neighbours(width: int, height: int):
+  """Get the square reached through each exit position of each square, for a
+  board of the given size. Index with square_index*8 + exitposition, each entry
+  is the index of the neighbouring square, or -1 if the exit leaves the board.
+  The table is built once per board size and shared between boards.
+  """
+  neighbours = _square_neighbours_cache.get((width, height))
+
+  if neighbours == None:
+    neighbours = []
+    for y in range(height):
+      for x in range(width):
+        for dx, dy, _ in CONNECTION_NEIGHBOURS:
+          nx = x + dx
+          ny = y + dy
+          if nx < 0 or nx >= width or ny < 0 or ny >= height:
+            neighbours.append(-1)
+          else:
+            neighbours.append(nx + ny*width)
+    neighbours = tuple(neighbours)
+    _square_neighbours_cache[(width, height)] = neighbours
+
+  return neighbours
+
+_square_edge_ports_cache = {}
+
+def square_edge_ports(width: int, height: int):
+  """Get the positions of each square that touch the edge of the board, for
+  a board of the given size. Index with the square index, each entry is a
+  tuple of positions, which is empty for squares away from the edge. Squares
+  with edge positions are the ones where first tiles can be placed, and the
+  edge positions are where tokens can start.
+  """
+  ports = _square_edge_ports_cache.get((width, height))
+
+  if ports == None:
+    neighbours = square_neighbours(width, height)
+    ports = tuple(
+      tuple(position for position in range(8) if neighbours[idx*8 + position] < 0)
+      for idx in range(width * height))
+    _square_edge_ports_cache[(width, height)] = ports
+
+  return ports
@@ -0,0 +1,161 @@
+# Tracing and profiling hooks for the server.
+#
+# A Tracer times named spans around functions. A function is only wrapped
+# while tracing is on; the rest of the time the original function is in its
+# place, so a span costs nothing when tracing is off.
+#
+# profile() turns tracing on for a number of seconds, samples the stack of
+# every thread meanwhile, and writes the span timings and the samples to a
+# file. Sampling sees all game threads at once, which cProfile, profiling
+# only the thread that starts it, would not.
+
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+
+
+class Span:
+    # Timings of one traced function
+
+    __slots__ = ('name', 'count', 'total', 'longest')
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+
+class Tracer:
+
+    def __init__(self):
+        self.hooks = []             # (owner, attribute, original, span)
+        self.spans = {}             # name -> Span
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    # Adds a span around the function owner.attribute. owner is a class or
+    # a module. The span is called 'Owner.attribute' unless named.
+    def add(self, owner, attribute, name=None):
+        if name is None:
+            name = '{}.{}'.format(owner.__name__, attribute)
+        original = vars(owner)[attribute]
+        span = self.spans.setdefault(name, Span(name))
+        self.hooks.append((owner, attribute, original, span))
+
+    def enable(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.enabled = True
+            for owner, attribute, original, span in self.hooks:
+                setattr(owner, attribute, self.wrap(original, span))
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            for owner, attribute, original, span in self.hooks:
+                setattr(owner, attribute, original)
+
+    # Returns original with its calls timed into span
+    def wrap(self, original, span):
+        lock = self.lock
+
+        @functools.wraps(original)
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with lock:
+                    span.count += 1
+                    span.total += elapsed
+                    if elapsed > span.longest:
+                        span.longest = elapsed
+
+        return traced
+
+    def reset(self):
+        with self.lock:
+            for span in self.spans.values():
+                span.count = 0
+                span.total = 0.0
+                span.longest = 0.0
+
+    # Returns a table of the span timings, the most time first
+    def summary(self):
+        lines = ['{:<40} {:>10} {:>12} {:>12} {:>12}'.format(
+            'span', 'calls', 'total ms', 'mean us', 'max us')]
+        with self.lock:
+            spans = sorted(self.spans.values(), key=lambda s: -s.total)
+            for span in spans:
+                mean = span.total / span.count if span.count else 0.0
+                lines.append('{:<40} {:>10} {:>12.2f} {:>12.1f} {:>12.1f}'.format(
+                    span.name, span.count, span.total * 1000, mean * 1e6,
+                    span.longest * 1e6))
+        return '\n'.join(lines) + '\n'
+
+
+# Name of the function a frame is running, for profiles
+def frame_name(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+
+# Samples the stack of every other thread every interval seconds, until the
+# given number of seconds have passed. Returns a Counter of stacks, each a
+# tuple of function names from the outermost call in.
+def sample_stacks(seconds, interval):
+    stacks = collections.Counter()
+    own = threading.get_ident()
+    end = time.monotonic() + seconds
+
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stacks[tuple(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return stacks
+
+
+# Traces and samples the process for the given number of seconds, then
+# writes the results to path: the span summary, the functions most often
+# running, and every sampled stack in the collapsed format flame graph
+# tools read.
+def profile(tracer, seconds, path, interval=0.005):
+    was_enabled = tracer.enabled
+    tracer.reset()
+    tracer.enable()
+    try:
+        stacks = sample_stacks(seconds, interval)
+    finally:
+        if not was_enabled:
+            tracer.disable()
+
+    running = collections.Counter()
+    for stack, count in stacks.items():
+        running[stack[-1]] += count
+    samples = sum(stacks.values()) or 1
+
+    with open(path, 'w') as f:
+        f.write('# {} seconds, {} samples\n\n'.format(seconds, samples))
+        f.write('# Spans\n')
+        f.write(tracer.summary())
+        f.write('\n# Most often running\n')
+        for name, count in running.most_common(30):
+            f.write('{:>6.1f}% {}\n'.format(count * 100 / samples, name))
+        f.write('\n# Stacks\n')
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(';'.join(stack), count))